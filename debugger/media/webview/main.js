@@ -3,11 +3,14 @@
 // It cannot access the main VS Code APIs directly.
 
 (function () {
-    document.addEventListener('DOMContentLoaded', (event) => {
-        // Toggle Campi Aggiuntivi
-        const toggles = document.querySelectorAll('.toggle');
-        var icon = document.createElement('i');
-        icon.className = 'codicon codicon-chevron-down';
+    const vscode = acquireVsCodeApi();
+
+    // acquireVsCodeApi can only be called once: the other scripts of the webview use this one
+    window.vscode = vscode;
+
+    // Toggle Campi Aggiuntivi
+    function bindToggles(root) {
+        const toggles = root.querySelectorAll('.toggle');
         toggles.forEach((button) => {
             button.classList.add("icon");
             let tmp = button.innerHTML;
@@ -16,9 +19,32 @@
             button.addEventListener('click', (event) => {
                 button.firstChild.classList.toggle('rotate');
                 button.parentNode.classList.toggle('toggled');
+
+                // The details of a process are requested the first time it is expanded
+                const pid = button.dataset.pid;
+                if (pid !== undefined && !button.dataset.requested) {
+                    button.dataset.requested = 'true';
+                    vscode.postMessage({ command: 'processDetail', pid: Number(pid) });
+                }
             });
         });
+    }
+
+    // Replies from the extension
+    window.addEventListener('message', (event) => {
+        const message = event.data;
+        switch (message.command) {
+            case 'processDetail':
+                document.querySelectorAll('.p-detail[data-pid="' + message.pid + '"]').forEach((placeholder) => {
+                    const list = placeholder.parentNode;
+                    placeholder.outerHTML = message.html;
+                    bindToggles(list);
+                });
+                break;
+        }
+    });
+
+    document.addEventListener('DOMContentLoaded', (event) => {
+        bindToggles(document);
     });
-    
-    
 }());
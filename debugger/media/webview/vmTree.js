@@ -26,22 +26,63 @@ function getListsIndexes(element, maxLevel = 4){
 }
 
 /**
- * Given an array of N indexes, returns a refrence to the N-th level sublist of a tree structure
+ * Given an array of N indexes, returns a reference to the node they lead to
  * @param {array[int]} indexArray Array of indexes, used to access every sublist
- * @returns {} Reference to the N-th level sublist, accessed using indexArray[i] for every level i
+ * @returns {} Reference to the node, or undefined if it does not exist
  */
-function getElementSubList(indexArray){
-    let elem = vmTreeStringified;
-
-    // Loop over all levels found
-    for(let i = 0; i < indexArray.length && elem; i++){
-        if(!elem || !elem[indexArray[i]]) return;
-        elem = elem[indexArray[i]].s[0];
+function getElementNode(indexArray){
+    let list = vmTreeStringified;
+    let node;
+
+    for(let i = 0; i < indexArray.length; i++){
+        if(!list || !list[indexArray[i]]) return;
+        node = list[indexArray[i]];
+        list = node.s[0];
     }
 
-    return elem;
+    return node;
+}
+
+// Subtrees asked to the extension and not received yet, by request id
+let pendingSubLists = {};
+let nextSubListRequest = 0;
+
+/**
+ * Returns the sublist of a node. The tables that have not been decoded yet (marked with "l")
+ * are asked to the extension (VmSubtree) and added to the tree when they arrive
+ * @param {} node Tree node
+ * @param {int} level Level of the table pointed by the node
+ * @returns {Promise} Promise of the sublist of the node
+ */
+function fetchSubList(node, level){
+    if(!node.l)
+        return Promise.resolve(node.s[0] || []);
+
+    return new Promise(resolve => {
+        let id = nextSubListRequest++;
+        pendingSubLists[id] = list => {
+            // the request failed: it is made again next time
+            if(!list){
+                resolve([]);
+                return;
+            }
+            delete node.l;
+            if(list.length > 0)
+                node.s = [list];
+            resolve(list);
+        };
+        window.vscode.postMessage({ command: 'vmSubtree', id: id, table: node.i.a, level: level });
+    });
 }
 
+window.addEventListener('message', event => {
+    const message = event.data;
+    if(message.command === 'vmSubtree' && pendingSubLists[message.id]){
+        pendingSubLists[message.id](message.list);
+        delete pendingSubLists[message.id];
+    }
+});
+
 /**
  * Deletes all siblings of a given element
  * @param {HTMLElement} element Target element, the only one who will be preserved
@@ -66,7 +107,7 @@ function createTabEntryParagraph(elementInfo){
  * @param {HTMLElement} callerElement Element whose children have to be shown. 
  *  It must have appropriate data-index attributes to work properly
  */
-function showSubList(callerElement){
+async function showSubList(callerElement){
     let divCallerElement = callerElement.parentElement;
     let treeIndexes = getListsIndexes(divCallerElement);
 
@@ -81,7 +122,12 @@ function showSubList(callerElement){
     
     // Otherwise show every child
     let elementLevel = treeIndexes.length + 1;
-    let subList = getElementSubList(treeIndexes);
+    let node = getElementNode(treeIndexes);
+    if(!node) return;
+    let subList = await fetchSubList(node, MAX_LIV - treeIndexes.length);
+
+    // the node may have been opened while waiting
+    if(parseInt(divCallerElement.getAttribute("data-opened"))) return;
 
     let i = 0;
     subList.forEach(element => {
@@ -173,7 +219,7 @@ function searchTabEntryByOctal(octal, sub_list){
     return -1;
 }
 
-function showTranslationPath(){
+async function showTranslationPath(){
     let vmAddress = document.getElementById("vmadd");
     let vmPathContainer = document.getElementById("vmPath");
 
@@ -243,8 +289,8 @@ function showTranslationPath(){
             break;
         }
 
-        // Repeat in the next level
-        vmTreeNode = vmTreeNode[subListIndex].s[0];
+        // Repeat in the next level (fetching it if it has not been decoded yet)
+        vmTreeNode = await fetchSubList(vmTreeNode[subListIndex], MAX_LIV - lev - 1);
     }
 
     // Print final physical address 
@@ -13,9 +13,9 @@ export function activate(context: vscode.ExtensionContext) {
 
     // Called whenever a debugger command is issued (continue / step / etc..)
     // In order to update information only when the debugger changes its state
+    // Both panels are updated with a single request
     vscode.debug.onDidChangeActiveStackItem(event => {
-        NucleoInfo.currentPanels[PanelType.Process]?.updateInformation();
-        NucleoInfo.currentPanels[PanelType.Memory]?.updateInformation();
+        NucleoInfo.updateAll(event);
     });
 
     vscode.debug.onDidTerminateDebugSession(() =>{
@@ -1,5 +1,6 @@
 // @ts-nocheck
 import * as vscode from 'vscode';
+import * as fs from 'fs';
 import * as ProcessInfoMethods from './nucleoinfo_proc';
 import * as VmInfoMethods from './nucleoinfo_vm';
 const Handlebars = require('handlebars');
@@ -18,10 +19,14 @@ export class NucleoInfo {
 	public procList: any | undefined;
 	public semList: any | undefined;
 	public procExecId: any | undefined;
+	public procExecDetail: any | undefined;
+	public procCount: number | undefined;
 	public codaPronti: any | undefined;
 	public codaSospesi: any | undefined;
 	public vmMaps: any | undefined;
 	public vmTree: any | undefined;
+	public vmShared: number[] | undefined;
+	public generation: number | undefined;
 	
     private readonly _panel: vscode.WebviewPanel;
 	private readonly _panelType: PanelType;
@@ -45,6 +50,14 @@ export class NucleoInfo {
 				this.formatCodaSospesi = ProcessInfoMethods.formatCodaSospesi.bind(this);
 				this.formatSemaphoreList = ProcessInfoMethods.formatSemaphoreList.bind(this);
 				this.formatProcesses = ProcessInfoMethods.formatProcesses.bind(this);
+				this.formatProcessDetail = ProcessInfoMethods.formatProcessDetail.bind(this);
+
+				// The webview asks for the details of a process the first time it is expanded
+				this._panel.webview.onDidReceiveMessage(
+					message => this.onProcessMessage(message),
+					null,
+					this._disposables
+				);
 
 				// Compiles the Handlebars templates once, at the start of the extension
 				this.templateProcess = this.compileProcessPanelTemplate();
@@ -58,6 +71,13 @@ export class NucleoInfo {
 				this.formatVmTree = VmInfoMethods.formatVmTree.bind(this);
 				// this.vmPathAnalyzer = VmInfoMethods.vmPathAnalyzer.bind(this);
 
+				// The webview asks for the tables below a node the first time it is expanded
+				this._panel.webview.onDidReceiveMessage(
+					message => this.onMemoryMessage(message),
+					null,
+					this._disposables
+				);
+
 				// Compiles the Handlebars templates once, at the start of the extension
 				this.templateVm = this.compileVmPanelTemplate();
 				this.compileVmTemplates();
@@ -65,30 +85,71 @@ export class NucleoInfo {
 				break;
 		}
 
+		// Shown until the first update
+		this._panel.webview.html = this.generateLoadingPage();
+
 		// Listen for when the panel is disposed: this happens when the user closes the panel
 		this._panel.onDidDispose(() => this.dispose(), null, this._disposables);
 	}
 
-	public async updateInformation (){
-		const infoPanel = this._panel.webview;
-		infoPanel.html = this.generateLoadingPage();
-		let retrievedInfo;
+	// Updates all the open panels with a single request to gdb
+	// activeStackItem is the stack item that has just become active, if any
+	public static async updateAll(activeStackItem?: vscode.DebugThread | vscode.DebugStackFrame){
+		const panels = NucleoInfo.currentPanels.filter(panel => panel !== undefined);
+		if(panels.length == 0)
+			return;
 
 		// Get active debug session
         const session = vscode.debug.activeDebugSession;
 
+		// a new stack item: the frame used for the previous requests may not exist anymore
+		NucleoInfo.frameId = activeStackItem instanceof vscode.DebugStackFrame ? activeStackItem.frameId : undefined;
+
+		// each panel asks for its section of NucleoAll
+		let command = "NucleoAll";
+		panels.forEach(panel => command += panel.sectionRequest());
+
+		// if the target has not changed since the last update (e.g. only a different
+		// stack frame was selected), gdb only returns the generation
+		const generations = new Set(panels.map(panel => panel.generation));
+		if(generations.size == 1 && panels[0].generation !== undefined)
+			command += " --since " + panels[0].generation;
+
+		const info = await NucleoInfo.fetchJson(session, command);
+		panels.forEach(panel => panel.showInformation(info));
+	}
+
+	// Sections (and options) of NucleoAll needed by this panel
+	private sectionRequest(): string {
 		switch(this._panelType){
 			case PanelType.Process:
+				// only a summary of each process is retrieved, the details are fetched on demand
+				return " process --summary";
+
+			case PanelType.Memory:
+				// only the root table is decoded, the tables below are fetched on demand
+				return " memory --depth 1 --shared";
+		}
+	}
+
+	private showInformation(info: any){
+		const infoPanel = this._panel.webview;
 
-				// retrieve all information and parse it
-				retrievedInfo = await this.customCommand(session, "ProcessAll");
-				let processInfoJson = JSON.parse(retrievedInfo);
+		switch(this._panelType){
+			case PanelType.Process:
+				// what the panel shows is still current
+				if(info.process === undefined)
+					return;
+				let processInfoJson = info.process;
 
 				this.codaPronti = processInfoJson.pronti;
 				this.codaSospesi = processInfoJson.sospesi;
 				this.semList = processInfoJson.semaphore;
 				this.procList = processInfoJson.processes;
+				this.procCount = processInfoJson.total;
 				this.procExecId = processInfoJson.exec;
+				// the process in execution is always shown in full
+				this.procExecDetail = processInfoJson.exec_detail;
 
 				// Format all information into an HTML page
 				infoPanel.html = this.templateProcess({
@@ -101,12 +162,14 @@ export class NucleoInfo {
 				break;
 
 			case PanelType.Memory:
+				// what the panel shows is still current
+				if(info.memory === undefined)
+					return;
+				let memoryInfoJson = info.memory;
 
-				// retrieve all information and parse it
-				retrievedInfo = await this.customCommand(session, "MemoryAll");
-				let memoryInfoJson = JSON.parse(retrievedInfo);
 				this.vmMaps = memoryInfoJson.maps;
 				this.vmTree = memoryInfoJson.tree;
+				this.vmShared = memoryInfoJson.shared;
 		
 				// Format all information into an HTML page
 				infoPanel.html = this.templateVm({
@@ -119,8 +182,47 @@ export class NucleoInfo {
 
 				break;
 		}
+
+		this.generation = info.generation;
 	};
 
+	private async onProcessMessage(message: any) {
+		switch(message.command){
+			case 'processDetail':
+				const session = vscode.debug.activeDebugSession;
+				const retrievedInfo = await NucleoInfo.customCommand(session, "ProcessDetail " + message.pid);
+				if(retrievedInfo === undefined)
+					return;
+				this._panel.webview.postMessage({
+					command: 'processDetail',
+					pid: message.pid,
+					html: this.formatProcessDetail(JSON.parse(retrievedInfo))
+				});
+				break;
+		}
+	}
+
+	private async onMemoryMessage(message: any) {
+		switch(message.command){
+			case 'vmSubtree':
+				const session = vscode.debug.activeDebugSession;
+				let list = null;
+				try {
+					const retrievedInfo = await NucleoInfo.fetchJson(session, "VmSubtree " + message.table + " " + message.level);
+					list = retrievedInfo.vm_tree;
+				}
+				catch {
+					// the webview asks again the next time the node is expanded
+				}
+				this._panel.webview.postMessage({
+					command: 'vmSubtree',
+					id: message.id,
+					list: list
+				});
+				break;
+		}
+	}
+
     public dispose() {
 		NucleoInfo.currentPanels[this._panelType] = undefined;
 		clearInterval(interval);
@@ -153,13 +255,26 @@ export class NucleoInfo {
         NucleoInfo.currentPanels[panelType] = new NucleoInfo(panel, panelType, extensionUri);
 	}
 
-    private async customCommand(session: typeof vscode.debug.activeDebugSession, command: string, arg?: any){
-		if(session) {
+	// Frame used for the evaluate requests, found once per stop
+	private static frameId: number | undefined;
+
+	private static async getFrameId(session: typeof vscode.debug.activeDebugSession){
+		if(NucleoInfo.frameId === undefined){
 			const sTrace = await session.customRequest('stackTrace', { threadId: 1 });
 			if(sTrace === undefined){
 				return;
 			}
-			const frameId = sTrace.stackFrames[0].id;
+			NucleoInfo.frameId = sTrace.stackFrames[0].id;
+		}
+		return NucleoInfo.frameId;
+	}
+
+    private static async customCommand(session: typeof vscode.debug.activeDebugSession, command: string, arg?: any){
+		if(session) {
+			const frameId = await NucleoInfo.getFrameId(session);
+			if(frameId === undefined){
+				return;
+			}
 		
 			// Build and exec the command
 			const text = '-exec ' + command;
@@ -170,6 +285,28 @@ export class NucleoInfo {
 		}     
     }
 
+	// Runs a command that accepts "--file": gdb writes the JSON to a file and only
+	// returns a handle to it, so that large outputs are not routed through the debug adapter
+	private static async fetchJson(session: typeof vscode.debug.activeDebugSession, command: string){
+		const retrievedInfo = await NucleoInfo.customCommand(session, command + " --file");
+		const handle = JSON.parse(retrievedInfo);
+		if(handle.file === undefined)
+			return handle;
+
+		try {
+			// every output has its own file, read once
+			const data = await fs.promises.readFile(handle.file);
+			fs.promises.unlink(handle.file).catch(() => {});
+			if(data.length != handle.length)
+				throw new Error("unexpected length");
+			return JSON.parse(data.toString('utf8'));
+		}
+		catch {
+			// gdb may be running on another machine: get the output through the debug adapter
+			return JSON.parse(await NucleoInfo.customCommand(session, command));
+		}
+	}
+
     private generateLoadingPage() {
 		let sourceDocument = `
 			<!DOCTYPE html>
@@ -317,6 +454,7 @@ export class NucleoInfo {
 	private formatCodaSospesi(): string;
 	private formatSemaphoreList() : string;
 	private formatProcesses() : string;
+	private formatProcessDetail(proc: any) : string;
 
 	private compileVmTemplates() : void;
 	private formatVmMaps() : string;
@@ -160,36 +160,9 @@ const sourceProcesses = `
 			<div class="toggable">
 				{{#each proc_sys}}
 					<div>
-						<p class="p-title toggle"><span>[{{pid}}]</span></p>
+						<p class="p-title toggle" data-pid="{{pid}}"><span>[{{pid}}]</span><span class="info">{{corpo}}{{#if coda}} - {{coda}}{{/if}}</span></p>
 						<ul class="p-dump toggable">
-							<li class="p-item"><span> pid = </span> <span class="value">{{pid}}</span></li>			
-							<li class="p-item"><span> livello = </span> <span class="value">{{livello}}</span></li>			
-							<li class="p-item"><span> corpo = </span> <span class="value">{{corpo}}</span></li>			
-							<li class="p-item"><span> rip = </span> <span class="value">{{rip}}</span></li>
-							<li class="p-ca-dump-list" >
-								<div class="toggle"><span>campi aggiuntivi</span><span class="info">: array[]</span></div> 
-								<ul class="toggable">
-									{{#each campi_aggiuntivi}}
-										<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
-									{{/each}}
-								</ul>
-							</li>
-							<li class="p-dump-list "> 
-								<div class="toggle"><span>dump Pila</span><span class="info">: array[]</span></div> 
-								<ul class="toggable">
-									{{#each pila_dmp}}
-										<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
-									{{/each}}
-								</ul>
-							</li>
-							<li class="p-dump-list"> 
-								<div class="toggle"><span>dump registri</span><span class="info">: array[]</span></div> 
-								<ul class="toggable">
-									{{#each reg_dmp}}
-										<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
-									{{/each}}
-								</ul>
-							</li>
+							<li class="p-detail" data-pid="{{pid}}"><span class="info">loading...</span></li>
 						</ul>
 					</div>
 				{{/each}}
@@ -200,36 +173,9 @@ const sourceProcesses = `
 			<div class="toggable">
 				{{#each proc_utn}}
 					<div>
-						<p class="p-title toggle"><span>[{{pid}}]</span></p>
+						<p class="p-title toggle" data-pid="{{pid}}"><span>[{{pid}}]</span><span class="info">{{corpo}}{{#if coda}} - {{coda}}{{/if}}</span></p>
 						<ul class="p-dump toggable">
-							<li class="p-item"><span> pid = </span> <span class="value">{{pid}}</span></li>			
-							<li class="p-item"><span> livello = </span> <span class="value">{{livello}}</span></li>			
-							<li class="p-item"><span> corpo = </span> <span class="value">{{corpo}}</span></li>			
-							<li class="p-item"><span> rip = </span> <span class="value">{{rip}}</span></li>
-							<li class="p-ca-dump-list" >
-								<div class="toggle"><span>campi aggiuntivi</span><span class="info">: array[]</span></div> 
-								<ul class="toggable">
-									{{#each campi_aggiuntivi}}
-										<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
-									{{/each}}
-								</ul>
-							</li>
-							<li class="p-dump-list "> 
-								<div class="toggle"><span>dump pila</span><span class="info">: array[]</span></div> 
-								<ul class="toggable">
-									{{#each pila_dmp}}
-										<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
-									{{/each}}
-								</ul>
-							</li>
-							<li class="p-dump-list"> 
-								<div class="toggle"><span>dump registri</span><span class="info">: array[]</span></div> 
-								<ul class="toggable">
-									{{#each reg_dmp}}
-										<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
-									{{/each}}
-								</ul>
-							</li>
+							<li class="p-detail" data-pid="{{pid}}"><span class="info">loading...</span></li>
 						</ul>
 					</div>
 				{{/each}}
@@ -237,6 +183,37 @@ const sourceProcesses = `
 		</div>
 	</div>
 	`;
+// Content of a process in the process list, sent to the webview when the process is expanded
+const sourceProcessDetail = `
+	<li class="p-item"><span> pid = </span> <span class="value">{{proc.pid}}</span></li>			
+	<li class="p-item"><span> livello = </span> <span class="value">{{proc.livello}}</span></li>			
+	<li class="p-item"><span> corpo = </span> <span class="value">{{proc.corpo}}</span></li>			
+	<li class="p-item"><span> rip = </span> <span class="value">{{proc.rip}}</span></li>
+	<li class="p-ca-dump-list" >
+		<div class="toggle"><span>campi aggiuntivi</span><span class="info">: array[]</span></div> 
+		<ul class="toggable">
+			{{#each proc.campi_aggiuntivi}}
+				<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
+			{{/each}}
+		</ul>
+	</li>
+	<li class="p-dump-list "> 
+		<div class="toggle"><span>dump pila</span><span class="info">: array[]</span></div> 
+		<ul class="toggable">
+			{{#each proc.pila_dmp}}
+				<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
+			{{/each}}
+		</ul>
+	</li>
+	<li class="p-dump-list"> 
+		<div class="toggle"><span>dump registri</span><span class="info">: array[]</span></div> 
+		<ul class="toggable">
+			{{#each proc.reg_dmp}}
+				<li class="p-dmp-item"> <span>{{@key}} =</span> <span class="value">{{this}}</span></li>
+			{{/each}}
+		</ul>
+	</li>
+	`;
 
 // Handlebars templates
 let templateEsecuzione;
@@ -244,6 +221,7 @@ let templateCodaPronti;
 let templateCodaSospesi;
 let templateSemaphoreList;
 let templateProcesses;
+let templateProcessDetail;
 
 // Compiles the templates once at the start of the extension
 export function compileProcessTemplates(this: any): void{
@@ -252,15 +230,15 @@ export function compileProcessTemplates(this: any): void{
 	templateCodaSospesi = Handlebars.compile(sourceCodaSospesi);
 	templateSemaphoreList = Handlebars.compile(sourceSemaphoreList);
 	templateProcesses = Handlebars.compile(sourceProcesses);
+	templateProcessDetail = Handlebars.compile(sourceProcessDetail);
 }
 
 export function formatEsecuzione(this: any): string{
 	if(isNaN(this.procExecId))
 		return `<div><h2>Esecuzione <span class="info title">empty</span></h2></div>`;
 	
-	let processInExecution = this.procList.find(proc => proc.pid == this.procExecId);
-
-	return templateEsecuzione({procExec: processInExecution});
+	// the process list only has a summary of each process, the details are fetched apart
+	return templateEsecuzione({procExec: this.procExecDetail});
 }
 
 export function formatCodaPronti(this: any): string {
@@ -324,7 +302,7 @@ export function formatSemaphoreList(this: any): string{
 }
 
 export function formatProcesses(this: any): string{
-	let proc_count = this.procList.length;
+	let proc_count = this.procCount;
 	let proc_sys: any = [];
 	let proc_utn: any = [];
 	this.procList.forEach(element => {
@@ -338,3 +316,7 @@ export function formatProcesses(this: any): string{
 		proc_count: proc_count
 	});
 }
+
+export function formatProcessDetail(this: any, proc: any): string{
+	return templateProcessDetail({proc: proc});
+}
@@ -12,8 +12,9 @@ let sourceVmMaps = `
 				{{#each info}}
 					<p>
 						<span class="vm_maps {{t}}">
-						{{a}} {{o}} {{x}}
+						{{a}} - {{e}} {{o}} {{x}}
 						</span>
+						<span class="info">{{n}} pagine</span>
 					</p>
 				{{/each}}
 				</div>		
@@ -30,6 +31,7 @@ let sourceVmTree = `
 			<div data-index-1="{{@index}}" data-opened="0">
 				<p onclick="showSubList(this)">
 					{{i.o}} - {{i.a}} - {{i.x}}
+					{{#if shared}}<span class="info">condivisa</span>{{/if}}
 				</p>
 			</div>
 		{{/each}}
@@ -48,9 +50,33 @@ export function compileVmTemplates(this: any): void{
 	templateVmTree = Handlebars.compile(sourceVmTree);
 }
 
+// Returns the translation path of a virtual address written in hexadecimal, as in "U-400-000-000-000"
+function vmOctalPath(addr: string, maxLiv: number): string {
+	let v = BigInt('0x' + addr);
+	let path: string[] = [(v >> 63n) ? 'U' : 'S'];
+	for(let i = maxLiv - 1; i >= 0; i--)
+		path.push(((v >> BigInt(12 + 9 * i)) & 0x1ffn).toString(8).padStart(3, '0'));
+	return path.join('-');
+}
+
 export function formatVmMaps(this: any): string{
+	// every run is [first address, last address, number of pages, index in the flags list]
+	let flags = this.vmMaps.flags;
+	let maxLiv = this.vmTree.depth_level;
 	let mem_part: any = [];
-	this.vmMaps.forEach(element => {mem_part.push(element)});
+	this.vmMaps.parts.forEach(element => {
+		mem_part.push({
+			part: element.part,
+			info: element.runs.map(run => ({
+				a: run[0],
+				e: run[1],
+				n: run[2],
+				o: vmOctalPath(run[0], maxLiv),
+				x: flags[run[3]].x,
+				t: flags[run[3]].t
+			}))
+		});
+	});
 
 	return templateVmMaps({
 		mem_part: mem_part
@@ -58,8 +84,12 @@ export function formatVmMaps(this: any): string{
 }
 	
 export function formatVmTree(this: any): string{
+	// root entries whose subtrees are shared with other processes
+	let shared = new Set(this.vmShared || []);
 	let vmTreeFirstLevel: any = [];
-	this.vmTree.vm_tree.forEach(element => {vmTreeFirstLevel.push(element);});	
+	this.vmTree.vm_tree.forEach(element => {
+		vmTreeFirstLevel.push({ i: element.i, shared: shared.has(parseInt(element.i.o, 8)) });
+	});
 	return templateVmTree({
 		vmTreeFirstLevel: vmTreeFirstLevel
 	});	
@@ -0,0 +1,132 @@
+"""Benchmark the commands of vscode_nucleo.py without QEMU.
+
+    python3 bench.py [-s SCENARIO ...] [-i IMAGE ...] [-c COMMAND ...]
+                     [-r REPEAT] [--json] [--module PATH]
+
+vscode_nucleo.py is loaded against the stand-in gdb module of this
+directory, backed either by images recorded with record.py (or snapshots
+saved with the NucleoSave command) or by the synthetic scenarios below
+(see image.Scenario). For each command the best wall time over the
+repetitions is reported, together with the
+number of read_memory calls, bytes read, parse_and_eval and execute calls
+of a single run. Every run starts as after a stop of the target, with the
+caches of vscode_nucleo.py invalidated.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, bench_dir)
+
+import gdb
+import image
+
+# each group scales one dimension, starting from the base scenario
+SCENARIOS = {
+    'base':       dict(nproc=8, nsem=16, pages=64),
+    'procs-64':   dict(nproc=64, nsem=16, pages=64),
+    'procs-256':  dict(nproc=256, nsem=16, pages=64, mem_mib=128),
+    'sems-256':   dict(nproc=8, nsem=256, pages=64),
+    'sems-1000':  dict(nproc=8, nsem=1000, pages=64),
+    'pages-512':  dict(nproc=8, nsem=16, pages=512),
+    'pages-2048': dict(nproc=8, nsem=16, pages=2048, mem_mib=64),
+}
+
+COMMANDS = [ 'ProcessAll', 'MemoryAll', 'FrameAll' ]
+
+def select_scenarios(names):
+    """scenarios matching names: a full name, or a group such as 'procs'"""
+    if not names:
+        return list(SCENARIOS)
+    out = []
+    for n in names:
+        match = [ s for s in SCENARIOS if s == n or s.split('-')[0] == n ]
+        if not match:
+            raise SystemExit("unknown scenario {} (known: {})".format(n, ", ".join(SCENARIOS)))
+        out += [ s for s in match if s not in out ]
+    return out
+
+def load_module(path, img):
+    """bind the stand-in gdb to img and (re)load vscode_nucleo.py on top of it"""
+    gdb.bind(img)
+    spec = importlib.util.spec_from_file_location('vscode_nucleo', path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    # every run has to compute its output, not find it ready from the previous stop
+    if 'nucleo-precompute' in gdb.parameters:
+        gdb.parameters['nucleo-precompute'].value = False
+    return mod
+
+def run_command(cmd, repeat):
+    best = None
+    for _ in range(repeat):
+        gdb.events.stop.fire(gdb.StopEvent())
+        gdb.take_output()
+        gdb.reset_stats()
+        t = time.perf_counter()
+        gdb.execute(cmd)
+        dt = time.perf_counter() - t
+        out = gdb.take_output()
+        if best is None or dt < best:
+            best = dt
+    res = dict(gdb.stats)
+    res['time_ms'] = best * 1000
+    res['output'] = len(out)
+    return res
+
+def bench(name, img, args):
+    load_module(args.module, img)
+    results = []
+    for cmd in args.command or COMMANDS:
+        res = run_command(cmd, args.repeat)
+        res['scenario'] = name
+        res['command'] = cmd
+        results.append(res)
+    return results
+
+# name, width and format of the columns of the table
+columns = [ ('scenario', -12, 's'), ('command', -24, 's'), ('time_ms', 10, '.2f'),
+            ('read_memory', 11, 'd'), ('read_bytes', 11, 'd'),
+            ('parse_and_eval', 14, 'd'), ('execute', 7, 'd'), ('output', 9, 'd') ]
+
+def print_table(results):
+    align = lambda w: '<' if w < 0 else '>'
+    print(" ".join("{:" + align(w) + str(abs(w)) + "s}" for _, w, _ in columns).format(*[ c for c, _, _ in columns ]))
+    row = " ".join("{:" + align(w) + str(abs(w)) + f + "}" for _, w, f in columns)
+    for r in results:
+        print(row.format(*[ r[c] for c, _, _ in columns ]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the commands of vscode_nucleo.py.")
+    parser.add_argument('-s', '--scenario', action='append',
+                        help="synthetic scenario or group ({})".format(", ".join(SCENARIOS)))
+    parser.add_argument('-i', '--image', action='append', default=[],
+                        help="image recorded with record.py or snapshot saved with NucleoSave "
+                             "(disables the default scenarios)")
+    parser.add_argument('-c', '--command', action='append',
+                        help="command to run (default: {})".format(", ".join(COMMANDS)))
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="runs of each command (default: 5)")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--module', default=os.path.join(bench_dir, '..', 'vscode_nucleo.py'),
+                        help="path of vscode_nucleo.py")
+    args = parser.parse_args()
+
+    results = []
+    for path in args.image:
+        results += bench(os.path.basename(path), image.MemoryImage.load(path), args)
+    if args.scenario or not args.image:
+        for name in select_scenarios(args.scenario):
+            results += bench(name, image.Scenario(**SCENARIOS[name]).build(), args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+if __name__ == '__main__':
+    main()
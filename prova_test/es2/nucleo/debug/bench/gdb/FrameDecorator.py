@@ -0,0 +1,6 @@
+"""Stand-in for gdb.FrameDecorator."""
+
+class FrameDecorator:
+
+    def __init__(self, base):
+        self._base = base
@@ -0,0 +1,618 @@
+"""Stand-in for the subset of the GDB Python API used by vscode_nucleo.py.
+
+The module is backed by a memory image (see image.py): global symbols,
+types and convenience variables come from the image metadata, memory reads
+are served from its pages.  Every entry point that would cost a round-trip
+to the remote target in a real session is counted in `stats`, so that the
+benchmark can report them next to the wall time.
+"""
+
+import re
+import struct
+
+#region Counters
+
+stats = {
+    'read_memory': 0,
+    'read_bytes': 0,
+    'parse_and_eval': 0,
+    'execute': 0,
+}
+
+def reset_stats():
+    for k in stats:
+        stats[k] = 0
+
+#endregion
+
+#region Errors and constants
+
+class error(RuntimeError):
+    pass
+
+class MemoryError(error):
+    pass
+
+class GdbError(Exception):
+    pass
+
+COMMAND_DATA = 1
+COMMAND_BREAKPOINTS = 4
+COMMAND_USER = 13
+COMPLETE_NONE = 0
+COMPLETE_FILENAME = 1
+COMPLETE_EXPRESSION = 5
+PARAM_BOOLEAN = 0
+PARAM_ZUINTEGER = 9
+BP_BREAKPOINT = 1
+
+TYPE_CODE_PTR = 1
+TYPE_CODE_ARRAY = 2
+TYPE_CODE_STRUCT = 3
+TYPE_CODE_UNION = 4
+TYPE_CODE_ENUM = 5
+TYPE_CODE_FUNC = 7
+TYPE_CODE_INT = 8
+TYPE_CODE_VOID = 10
+TYPE_CODE_BOOL = 20
+TYPE_CODE_TYPEDEF = 23
+
+#endregion
+
+#region Image binding
+
+_image = None
+_output = []
+
+def bind(image):
+    """use image as the target of all the following calls"""
+    global _image, _inferior
+    _image = image
+    _inferior = Inferior()
+    for reg in events.__dict__.values():
+        if isinstance(reg, EventRegistry):
+            reg.handlers = []
+    commands.clear()
+    parameters.clear()
+    breakpoints_list.clear()
+
+def take_output():
+    """return (and forget) everything written through gdb.write"""
+    s = "".join(_output)
+    del _output[:]
+    return s
+
+def write(s, stream=0):
+    _output.append(s)
+
+def flush(stream=0):
+    pass
+
+#endregion
+
+#region Types
+
+class Field:
+
+    def __init__(self, name, type, bitpos):
+        self.name = name
+        self.type = type
+        self.bitpos = bitpos
+        self.bitsize = 0
+        self.artificial = False
+        self.is_base_class = False
+
+class Type:
+
+    def __init__(self, name, code, sizeof, target=None, fields=None, length=None, signed=False):
+        self.name = name
+        self.code = code
+        self.sizeof = sizeof
+        self._target = target
+        self._fields = fields or []
+        self._length = length
+        self.is_signed = signed
+
+    def fields(self):
+        if self.code not in (TYPE_CODE_STRUCT, TYPE_CODE_UNION, TYPE_CODE_FUNC):
+            raise TypeError("Type is not a structure, union, enum, or function type.")
+        return list(self._fields)
+
+    def target(self):
+        if self._target is None:
+            raise RuntimeError("Type does not have a target.")
+        return self._target
+
+    def pointer(self):
+        return Type(None, TYPE_CODE_PTR, 8, target=self)
+
+    def array(self, n):
+        return Type(None, TYPE_CODE_ARRAY, self.sizeof * (n + 1), target=self, length=n + 1)
+
+    def range(self):
+        return (0, self._length - 1)
+
+    def strip_typedefs(self):
+        return self
+
+    def unqualified(self):
+        return self
+
+    def __eq__(self, other):
+        if not isinstance(other, Type):
+            return False
+        if self is other:
+            return True
+        if self.code != other.code:
+            return False
+        if self.code in (TYPE_CODE_PTR, TYPE_CODE_ARRAY):
+            return self._target == other._target and self._length == other._length
+        return self.name == other.name and self.sizeof == other.sizeof
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.code, self.name, self.sizeof))
+
+    def __str__(self):
+        if self.code == TYPE_CODE_PTR:
+            return "{} *".format(self._target)
+        if self.code == TYPE_CODE_ARRAY:
+            return "{} [{}]".format(self._target, self._length)
+        return self.name or '<anonymous>'
+
+    def _field(self, name):
+        for f in self._fields:
+            if f.name == name:
+                return f.bitpos // 8, f.type
+            if f.name is None and f.type.code in (TYPE_CODE_STRUCT, TYPE_CODE_UNION):
+                r = f.type._field(name)
+                if r is not None:
+                    return f.bitpos // 8 + r[0], r[1]
+        return None
+
+def lookup_type(name):
+    try:
+        return _image.types[name]
+    except KeyError:
+        raise error("No type named {}.".format(name))
+
+#endregion
+
+#region Values
+
+_long = Type('long', TYPE_CODE_INT, 8, signed=True)
+_int_formats = { 1: 'B', 2: 'H', 4: 'I', 8: 'Q' }
+
+def _read(addr, size):
+    stats['read_memory'] += 1
+    stats['read_bytes'] += size
+    return _image.read(addr, size)
+
+class Value:
+
+    def __init__(self, val, type=None):
+        self._address = None
+        self._bytes = None
+        if isinstance(val, Value):
+            self.type = val.type
+            self._address = val._address
+            self._bytes = val._bytes
+            self._int = val._int
+            return
+        if type is not None:
+            # gdb.Value(buffer, type): a value built from raw bytes
+            self.type = type
+            self._bytes = bytes(val)[:type.sizeof]
+            self._int = None
+            return
+        if isinstance(val, bool):
+            val = int(val)
+        if not isinstance(val, int):
+            raise TypeError("Could not convert Python object: {!r}.".format(val))
+        self.type = _long
+        self._int = val
+
+    @classmethod
+    def _at(cls, addr, type):
+        v = cls(0)
+        v.type = type
+        v._address = addr
+        v._int = None
+        return v
+
+    def _raw(self):
+        if self._bytes is None:
+            self._bytes = _read(self._address, self.type.sizeof)
+        return self._bytes
+
+    def _value(self):
+        if self._int is not None:
+            return self._int
+        t = self.type
+        if t.code in (TYPE_CODE_INT, TYPE_CODE_PTR, TYPE_CODE_BOOL, TYPE_CODE_ENUM):
+            fmt = _int_formats[t.sizeof]
+            if t.is_signed:
+                fmt = fmt.lower()
+            self._int = struct.unpack('<' + fmt, self._raw())[0]
+            return self._int
+        if t.code == TYPE_CODE_ARRAY and self._address is not None:
+            return self._address
+        raise error("Cannot convert value to long.")
+
+    @property
+    def address(self):
+        if self._address is None:
+            return None
+        v = Value(self._address)
+        v.type = self.type.pointer()
+        return v
+
+    @property
+    def is_optimized_out(self):
+        return False
+
+    def cast(self, type):
+        v = Value(self._value())
+        if type.code == TYPE_CODE_INT and type.sizeof < 8:
+            v._int &= (1 << (8 * type.sizeof)) - 1
+        elif type.code == TYPE_CODE_INT and not type.is_signed:
+            v._int &= (1 << 64) - 1
+        v.type = type
+        return v
+
+    def dereference(self):
+        if self.type.code != TYPE_CODE_PTR:
+            raise error("Attempt to take contents of a non-pointer value.")
+        return Value._at(self._value(), self.type.target())
+
+    def __getitem__(self, key):
+        t = self.type
+        if isinstance(key, Field):
+            key = key.name
+        if isinstance(key, str):
+            if t.code == TYPE_CODE_PTR:
+                return self.dereference()[key]
+            r = t._field(key)
+            if r is None:
+                raise error("There is no member named {}.".format(key))
+            off, ft = r
+            if self._address is None:
+                return Value(self._raw()[off:off + ft.sizeof], ft)
+            return Value._at(self._address + off, ft)
+        idx = int(key)
+        if t.code == TYPE_CODE_ARRAY:
+            et = t.target()
+            if self._address is None:
+                return Value(self._raw()[idx * et.sizeof:(idx + 1) * et.sizeof], et)
+            return Value._at(self._address + idx * et.sizeof, et)
+        if t.code == TYPE_CODE_PTR:
+            et = t.target()
+            return Value._at(self._value() + idx * et.sizeof, et)
+        raise error("cannot subscript something of type `{}'".format(t))
+
+    def __int__(self):
+        return self._value()
+
+    __index__ = __int__
+
+    def __bool__(self):
+        return self._value() != 0
+
+    def __eq__(self, other):
+        if isinstance(other, Value):
+            other = other._value()
+        return self._value() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self._value() < int(other)
+
+    def __gt__(self, other):
+        return self._value() > int(other)
+
+    def __hash__(self):
+        return hash(self._value())
+
+    def __add__(self, other):
+        return Value(self._value() + int(other))
+
+    def __str__(self):
+        t = self.type
+        if t.code == TYPE_CODE_PTR:
+            addr = self._value()
+            s = "0x{:x}".format(addr)
+            sym = _image.symbolize(addr) if addr else None
+            if sym:
+                s += " <{}>".format(sym)
+            return s
+        if t.code in (TYPE_CODE_INT, TYPE_CODE_ENUM):
+            return str(self._value())
+        if t.code == TYPE_CODE_BOOL:
+            return 'true' if self._value() else 'false'
+        if t.code in (TYPE_CODE_STRUCT, TYPE_CODE_UNION):
+            return "{" + ", ".join("{} = {}".format(f.name, self[f.name]) for f in t.fields() if f.name) + "}"
+        if t.code == TYPE_CODE_ARRAY:
+            return "{" + ", ".join(str(self[i]) for i in range(t._length)) + "}"
+        return "<{}>".format(t)
+
+    def format_string(self, **kw):
+        return str(self)
+
+#endregion
+
+#region Expressions
+
+_token = re.compile(r'\s*(?:(0x[0-9a-fA-F]+|\d+)|(\$?[A-Za-z_]\w*)|(->|[\[\]\.&*()]))')
+
+def _tokens(expr):
+    pos = 0
+    out = []
+    expr = expr.strip()
+    while pos < len(expr):
+        m = _token.match(expr, pos)
+        if not m:
+            raise error("A syntax error in expression, near `{}'.".format(expr[pos:]))
+        pos = m.end()
+        if m.group(1):
+            out.append(('num', int(m.group(1), 0)))
+        elif m.group(2):
+            out.append(('id', m.group(2)))
+        else:
+            out.append(('op', m.group(3)))
+    return out
+
+def _primary(toks):
+    kind, tok = toks.pop(0)
+    if kind == 'num':
+        return Value(tok)
+    if kind == 'op' and tok == '(':
+        v = _unary(toks)
+        toks.pop(0)
+        return v
+    if kind == 'op' and tok in ('&', '*'):
+        v = _unary_postfix(toks)
+        if tok == '&':
+            return v.address
+        return v.dereference()
+    if tok.startswith('$'):
+        name = tok[1:]
+        if name in _image.registers:
+            v = Value(_image.registers[name])
+            return v
+        if name in _image.convenience:
+            return Value(_image.convenience[name])
+        return Value(0)
+    if tok in _image.symbols:
+        addr, type = _image.symbols[tok]
+        return Value._at(addr, type)
+    if tok in _image.constants:
+        return Value(_image.constants[tok])
+    raise error('No symbol "{}" in current context.'.format(tok))
+
+def _unary_postfix(toks):
+    v = _primary(toks)
+    while toks and toks[0][0] == 'op' and toks[0][1] in ('[', '->', '.'):
+        op = toks.pop(0)[1]
+        if op == '[':
+            idx = _unary(toks)
+            toks.pop(0)
+            v = v[int(idx)]
+        else:
+            name = toks.pop(0)[1]
+            if op == '->':
+                v = v.dereference()
+            v = v[name]
+    return v
+
+def _unary(toks):
+    return _unary_postfix(toks)
+
+def parse_and_eval(expr, global_context=False):
+    stats['parse_and_eval'] += 1
+    toks = _tokens(expr)
+    v = _unary(toks)
+    if toks:
+        raise error("A syntax error in expression, near `{}'.".format(expr))
+    return v
+
+def string_to_argv(s):
+    return s.split()
+
+#endregion
+
+#region Commands, parameters, events
+
+commands = {}
+parameters = {}
+
+class Command:
+
+    def __init__(self, name, command_class, completer_class=COMPLETE_NONE, prefix=False):
+        commands[name] = self
+
+    def dont_repeat(self):
+        pass
+
+class Parameter:
+
+    def __init__(self, name, command_class, parameter_class):
+        self.value = None
+        parameters[name] = self
+
+class Function:
+
+    def __init__(self, name):
+        pass
+
+class EventRegistry:
+
+    def __init__(self):
+        self.handlers = []
+
+    def connect(self, f):
+        self.handlers.append(f)
+
+    def disconnect(self, f):
+        self.handlers.remove(f)
+
+    def fire(self, event=None):
+        for f in list(self.handlers):
+            f(event)
+
+class _Events:
+    pass
+
+events = _Events()
+for _name in ('stop', 'cont', 'exited', 'memory_changed', 'register_changed',
+              'inferior_call_pre', 'inferior_call_post', 'new_objfile', 'clear_objfiles',
+              'before_prompt', 'breakpoint_created', 'breakpoint_deleted'):
+    setattr(events, _name, EventRegistry())
+
+class StopEvent:
+    pass
+
+class BreakpointEvent(StopEvent):
+
+    def __init__(self, breakpoints):
+        self.breakpoints = breakpoints
+        self.breakpoint = breakpoints[0]
+
+class MemoryChangedEvent:
+
+    def __init__(self, address, length):
+        self.address = address
+        self.length = length
+
+def execute(cmd, from_tty=False, to_string=False):
+    stats['execute'] += 1
+    m = re.match(r'info symbol (0x[0-9a-fA-F]+|\d+)$', cmd.strip())
+    if m:
+        addr = int(m.group(1), 0)
+        sym = _image.lookup_function(addr)
+        if sym is None:
+            s = "No symbol matches {}.\n".format(m.group(1))
+        else:
+            name, start, objfile = sym
+            off = "" if addr == start else " + {}".format(addr - start)
+            s = "{}{} in section .text of {}\n".format(name, off, objfile)
+        if to_string:
+            return s
+        write(s)
+        return None
+    if cmd.split()[0] in commands:
+        name, _, arg = cmd.partition(' ')
+        commands[name].invoke(arg, from_tty)
+        if to_string:
+            return take_output()
+        return None
+    raise error('Undefined command: "{}".'.format(cmd))
+
+#endregion
+
+#region Inferior, symbols and blocks
+
+class Inferior:
+
+    num = 1
+
+    def read_memory(self, addr, length):
+        return memoryview(_read(int(addr), int(length)))
+
+    def write_memory(self, addr, buf, length=None):
+        data = bytes(buf)[:length]
+        _image.write(int(addr), data)
+        events.memory_changed.fire(MemoryChangedEvent(int(addr), len(data)))
+
+_inferior = None
+
+def selected_inferior():
+    return _inferior
+
+def inferiors():
+    return (_inferior,)
+
+class Objfile:
+
+    def __init__(self, filename):
+        self.filename = filename
+
+class Symtab:
+
+    def __init__(self, objfile):
+        self.objfile = objfile
+        self.filename = objfile.filename
+
+class Symbol:
+
+    def __init__(self, name, objfile):
+        self.name = name
+        self.symtab = Symtab(objfile)
+        self.print_name = name
+
+    def __str__(self):
+        return self.name
+
+class Block:
+
+    def __init__(self, start, end, function, superblock=None):
+        self.start = start
+        self.end = end
+        self.function = function
+        self.superblock = superblock
+
+def block_for_pc(pc):
+    sym = _image.lookup_function(pc)
+    if sym is None:
+        return None
+    name, start, objfile = sym
+    return Block(start, start + 1, Symbol(name, Objfile(objfile)))
+
+class Progspace:
+
+    filename = None
+
+    def solib_name(self, addr):
+        return None
+
+    def block_for_pc(self, pc):
+        return block_for_pc(pc)
+
+def current_progspace():
+    return Progspace()
+
+def objfiles():
+    return []
+
+#endregion
+
+#region Breakpoints
+
+breakpoints_list = []
+
+class Breakpoint:
+
+    def __init__(self, spec, type=BP_BREAKPOINT, internal=False, temporary=False):
+        self.location = spec
+        self.enabled = True
+        self.hit_count = 0
+        self.number = len(breakpoints_list) + 1
+        self.condition = None
+        breakpoints_list.append(self)
+
+    def delete(self):
+        breakpoints_list.remove(self)
+
+    def is_valid(self):
+        return self in breakpoints_list
+
+def breakpoints():
+    return tuple(breakpoints_list)
+
+#endregion
+
+frame_filters = {}
+pretty_printers = []
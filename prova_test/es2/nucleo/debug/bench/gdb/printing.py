@@ -0,0 +1,11 @@
+"""Stand-in for gdb.printing."""
+
+class PrettyPrinter:
+
+    def __init__(self, name, subprinters=None):
+        self.name = name
+        self.subprinters = subprinters
+        self.enabled = True
+
+def register_pretty_printer(obj, printer, replace=False):
+    pass
@@ -0,0 +1,541 @@
+"""Memory images for the stand-in gdb module.
+
+A MemoryImage holds the physical memory of the machine (sparse, one
+bytearray per touched page) plus everything vscode_nucleo.py looks up by
+name: types, global symbols, convenience variables, registers and the
+function symbols used to decode `corpo` and saved `rip` values.
+
+Images come either from a recording made in a real QEMU session (see
+record.py, loaded with MemoryImage.load), from a snapshot saved with the
+NucleoSave command of vscode_nucleo.py (only the pages the nucleo data
+structures live in, also loaded with MemoryImage.load), or from the synthetic
+Scenario builder, which lays out the nucleo data structures the same way
+sistema.cpp does and scales the number of processes, semaphores and mapped pages.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import zipfile
+
+import gdb
+
+# the description of the nucleo and the snapshot format are shared with vscode_nucleo.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nucleo_snapshot import (DIM_PAGINA, TYPE_CODES, TYPE_CODE_NAMES,
+                             SNAPSHOT_MAGIC, SNAPSHOT_VERSION, snapshot_header)
+
+MiB = 1 << 20
+
+#region Image
+
+class MemoryImage:
+
+    def __init__(self, mem_tot):
+        self.mem_tot = mem_tot
+        self.pages = {}
+        self.types = {}
+        self.symbols = {}
+        self.constants = {}
+        self.convenience = {}
+        self.registers = {}
+        self._fun_starts = []
+        self._funs = []
+
+    def read(self, addr, size):
+        if addr < 0 or addr + size > self.mem_tot:
+            raise gdb.MemoryError("Cannot access memory at address 0x{:x}".format(addr))
+        out = bytearray()
+        while size > 0:
+            frame, off = divmod(addr, DIM_PAGINA)
+            n = min(size, DIM_PAGINA - off)
+            page = self.pages.get(frame)
+            out += page[off:off + n] if page is not None else bytes(n)
+            addr += n
+            size -= n
+        return bytes(out)
+
+    def write(self, addr, data):
+        data = memoryview(bytes(data))
+        while len(data):
+            frame, off = divmod(addr, DIM_PAGINA)
+            n = min(len(data), DIM_PAGINA - off)
+            page = self.pages.get(frame)
+            if page is None:
+                page = self.pages[frame] = bytearray(DIM_PAGINA)
+            page[off:off + n] = data[:n]
+            addr += n
+            data = data[n:]
+
+    def write_q(self, addr, v):
+        self.write(addr, struct.pack('<Q', v & 0xffffffffffffffff))
+
+    def add_function(self, name, start, objfile):
+        i = bisect.bisect(self._fun_starts, start)
+        self._fun_starts.insert(i, start)
+        self._funs.insert(i, (name, start, objfile))
+
+    def lookup_function(self, addr):
+        i = bisect.bisect(self._fun_starts, addr) - 1
+        if i < 0:
+            return None
+        name, start, objfile = self._funs[i]
+        if addr - start >= 0x1000:
+            return None
+        return self._funs[i]
+
+    def symbolize(self, addr):
+        f = self.lookup_function(addr)
+        if f is None:
+            return None
+        name, start, _ = f
+        return name if addr == start else "{}+{}".format(name, addr - start)
+
+    #region Persistence
+
+    def save(self, path):
+        meta = {
+            'mem_tot': self.mem_tot,
+            'types': { n: _type_to_json(t) for n, t in self.types.items() },
+            'symbols': { n: [a, _type_ref(t)] for n, (a, t) in self.symbols.items() },
+            'constants': self.constants,
+            'convenience': self.convenience,
+            'registers': self.registers,
+            'functions': self._funs,
+        }
+        write_image(path, meta, self.pages)
+
+    @classmethod
+    def load(cls, path):
+        """load an image recorded by record.py or a snapshot saved by NucleoSave"""
+        with open(path, 'rb') as f:
+            if f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+                return cls.load_snapshot(path)
+        with zipfile.ZipFile(path) as z:
+            meta = json.loads(z.read('meta.json'))
+            mem = z.read('memory.bin')
+        if meta.get('version') != IMAGE_VERSION:
+            raise ValueError("{}: unsupported image version {}".format(path, meta.get('version')))
+        img = cls.from_meta(meta)
+        for i, f in enumerate(meta['pages']):
+            img.pages[f] = bytearray(mem[i * DIM_PAGINA:(i + 1) * DIM_PAGINA])
+        return img
+
+    @classmethod
+    def load_snapshot(cls, path):
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, page_size, npages, index_off, data_off, meta_off, meta_len = snapshot_header.unpack_from(mm)
+            if version != SNAPSHOT_VERSION or page_size != DIM_PAGINA:
+                raise ValueError("{}: unsupported snapshot version {}".format(path, version))
+            meta = json.loads(mm[meta_off:meta_off + meta_len])
+            img = cls.from_meta(meta)
+            frames = struct.unpack_from('<{}Q'.format(npages), mm, index_off)
+            for i, f in enumerate(frames):
+                off = data_off + i * DIM_PAGINA
+                img.pages[f] = bytearray(mm[off:off + DIM_PAGINA])
+        finally:
+            mm.close()
+        return img
+
+    @classmethod
+    def from_meta(cls, meta):
+        """an image with everything but the memory, from its description"""
+        img = cls(meta['mem_tot'])
+        img.types = types_from_json(meta['types'])
+        for n, (a, ref) in meta['symbols'].items():
+            img.symbols[n] = (a, _resolve(ref, img.types))
+        img.constants = meta['constants']
+        img.convenience = meta['convenience']
+        img.registers = meta['registers']
+        for name, start, objfile in meta['functions']:
+            img.add_function(name, start, objfile)
+        return img
+
+    #endregion
+
+IMAGE_VERSION = 1
+
+def write_image(path, meta, pages):
+    """
+    Write an image file: meta.json (everything but the memory) and
+    memory.bin (the pages listed in meta['pages'], in order).
+    pages maps frame numbers to the content of the frame.
+    """
+    meta = dict(meta, version=IMAGE_VERSION, pages=sorted(pages))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('meta.json', json.dumps(meta))
+        z.writestr('memory.bin', b"".join(bytes(pages[f]) for f in meta['pages']))
+
+def _type_ref(t):
+    if t.code == gdb.TYPE_CODE_PTR:
+        return { 'ptr': _type_ref(t.target()) }
+    if t.code == gdb.TYPE_CODE_ARRAY:
+        return { 'array': _type_ref(t.target()), 'n': t.range()[1] + 1 }
+    if t.name is None:
+        return _type_to_json(t)
+    return t.name
+
+def _type_to_json(t):
+    d = { 'name': t.name, 'code': TYPE_CODE_NAMES[t.code], 'sizeof': t.sizeof, 'signed': bool(getattr(t, 'is_signed', False)) }
+    if t.code in (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION):
+        d['fields'] = [ [f.name, f.bitpos, _type_ref(f.type)] for f in t.fields() ]
+    return d
+
+def types_from_json(desc):
+    """rebuild a name -> gdb.Type dictionary from its JSON description"""
+    types = {}
+    for n, d in desc.items():
+        types[n] = gdb.Type(d['name'], TYPE_CODES[d['code']], d['sizeof'], signed=d['signed'])
+    for n, d in desc.items():
+        if 'fields' in d:
+            types[n]._fields = _fields_from_json(d['fields'], types)
+    return types
+
+def _fields_from_json(fields, types):
+    return [ gdb.Field(name, _resolve(ref, types), bitpos) for name, bitpos, ref in fields ]
+
+def _resolve(ref, types):
+    if isinstance(ref, str):
+        return types[ref]
+    if 'ptr' in ref:
+        return _resolve(ref['ptr'], types).pointer()
+    if 'array' in ref:
+        return _resolve(ref['array'], types).array(ref['n'] - 1)
+    t = gdb.Type(ref['name'], TYPE_CODES[ref['code']], ref['sizeof'], signed=ref['signed'])
+    if 'fields' in ref:
+        t._fields = _fields_from_json(ref['fields'], types)
+    return t
+
+#endregion
+
+#region Nucleo layout
+
+def nucleo_types():
+    """types of sistema.cpp, with the x86-64 layout produced by g++"""
+    def integer(name, size, signed=False):
+        return gdb.Type(name, gdb.TYPE_CODE_INT, size, signed=signed)
+    t = {}
+    for name, size, signed in (('natb', 1, False), ('natw', 2, False), ('natl', 4, False),
+                               ('natq', 8, False), ('int', 4, True), ('long', 8, True),
+                               ('unsigned long', 8, False), ('paddr', 8, False), ('vaddr', 8, False)):
+        t[name] = integer(name, size, signed)
+    t['void'] = gdb.Type('void', gdb.TYPE_CODE_VOID, 1)
+    t['bool'] = gdb.Type('bool', gdb.TYPE_CODE_BOOL, 1)
+
+    dp = t['des_proc'] = gdb.Type('des_proc', gdb.TYPE_CODE_STRUCT, 184)
+    corpo = gdb.Type(None, gdb.TYPE_CODE_FUNC, 1, target=t['void']).pointer()
+    dp._fields = [
+        gdb.Field('id', t['natw'], 0),
+        gdb.Field('livello', t['natw'], 16),
+        gdb.Field('precedenza', t['natl'], 32),
+        gdb.Field('punt_nucleo', t['vaddr'], 64),
+        gdb.Field('contesto', t['natq'].array(15), 128),
+        gdb.Field('cr3', t['paddr'], 1152),
+        gdb.Field('barrier_id', t['natl'], 1216),
+        gdb.Field('puntatore', dp.pointer(), 1280),
+        gdb.Field('corpo', corpo, 1344),
+        gdb.Field('parametro', t['natq'], 1408),
+    ]
+    ds = t['des_sem'] = gdb.Type('des_sem', gdb.TYPE_CODE_STRUCT, 16)
+    ds._fields = [
+        gdb.Field('counter', t['int'], 0),
+        gdb.Field('pointer', dp.pointer(), 64),
+    ]
+    r = t['richiesta'] = gdb.Type('richiesta', gdb.TYPE_CODE_STRUCT, 24)
+    r._fields = [
+        gdb.Field('d_attesa', t['natl'], 0),
+        gdb.Field('p_rich', r.pointer(), 64),
+        gdb.Field('pp', dp.pointer(), 128),
+    ]
+    u = gdb.Type(None, gdb.TYPE_CODE_UNION, 4)
+    u._fields = [
+        gdb.Field('nvalide', t['natw'], 0),
+        gdb.Field('prossimo_libero', t['natl'], 0),
+    ]
+    df = t['des_frame'] = gdb.Type('des_frame', gdb.TYPE_CODE_STRUCT, 4)
+    df._fields = [ gdb.Field(None, u, 0) ]
+    return t
+
+CONVENIENCE = {
+    'MAX_LIV': 4, 'MAX_SEM': 1024,
+    'SEL_CODICE_SISTEMA': 8, 'SEL_CODICE_UTENTE': 19, 'SEL_DATI_UTENTE': 27,
+    'MAX_PROC': 1024, 'MAX_PRIORITY': 1023, 'MIN_PRIORITY': 1,
+    'I_SIS_C': 0, 'I_SIS_P': 1, 'I_MIO_C': 2, 'I_UTN_C': 256, 'I_UTN_P': 384,
+}
+
+#endregion
+
+#region Synthetic scenarios
+
+BIT_P, BIT_W, BIT_U, BIT_A, BIT_D, BIT_PS = 1, 2, 4, 32, 64, 128
+
+class Scenario:
+    """Build a MemoryImage that looks like a nucleo stopped in sistema.
+
+    nproc       number of live processes (the first two are system processes)
+    nsem        number of allocated user semaphores (plus nsem // 4 system ones)
+    pages       number of private user pages mapped by each user process
+    mem_mib     size of the physical memory
+    """
+
+    def __init__(self, nproc=8, nsem=16, pages=64, mem_mib=32):
+        self.nproc = nproc
+        self.nsem = nsem
+        self.pages = pages
+        self.mem_mib = mem_mib
+
+    def build(self):
+        img = self.img = MemoryImage(self.mem_mib * MiB)
+        img.types = nucleo_types()
+        img.convenience = dict(CONVENIENCE)
+        t = img.types
+        self.n_frame = img.mem_tot // DIM_PAGINA
+        self.n_m1 = 1024
+        self._layout_globals()
+        self._init_frames()
+        self._functions()
+        self._shared_tables()
+        pids = self._processes()
+        self._queues(pids)
+        self._finish_frames()
+        esec = self.procs[pids[-1]]
+        img.registers = {
+            'cr3': esec['cr3'], 'cs': 8, 'cr0': 0x80010011, 'rip': self.sys_funs['c_sem_wait'] + 12,
+            'eflags': 0x46,
+        }
+        for i, r in enumerate(('rax', 'rcx', 'rdx', 'rbx', 'rsp', 'rbp', 'rsi', 'rdi',
+                               'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15')):
+            img.registers[r] = 0x1000 * i + 7
+        return img
+
+    def _layout_globals(self):
+        img, t = self.img, self.img.types
+        sym = img.symbols
+        base = [0x110000]
+        def glob(name, type, count=None):
+            if count is not None:
+                type = type.array(count - 1)
+            addr = (base[0] + 15) & ~15
+            base[0] = addr + type.sizeof
+            sym[name] = (addr, type)
+            return addr
+        self.a_proc_table = glob('proc_table', t['des_proc'].pointer(), 1024)
+        self.a_processi = glob('processi', t['natl'])
+        self.a_esecuzione = glob('esecuzione', t['des_proc'].pointer())
+        self.a_pronti = glob('pronti', t['des_proc'].pointer())
+        self.a_array_dess = glob('array_dess', t['des_sem'], 2048)
+        self.a_sem_utn = glob('sem_allocati_utente', t['natl'])
+        self.a_sem_sis = glob('sem_allocati_sistema', t['natl'])
+        self.a_sospesi = glob('sospesi', t['richiesta'].pointer())
+        self.a_vdf = glob('vdf', t['des_frame'], self.n_frame)
+        self.a_n_m1 = glob('N_M1', t['natq'])
+        self.a_n_m2 = glob('N_M2', t['natq'])
+        self.a_n_frame = glob('N_FRAME', t['natq'])
+        self.a_primo = glob('primo_frame_libero', t['natq'])
+        self.a_num_liberi = glob('num_frame_liberi', t['natq'])
+        self.a_dummy_prio = glob('DUMMY_PRIORITY', t['natl'])
+        self.heap = 0x200000
+
+    def _alloc(self, size):
+        addr = (self.heap + 15) & ~15
+        self.heap = addr + size
+        return addr
+
+    def _init_frames(self):
+        # every frame of M2 starts free; alloca_frame() takes them in order
+        self.next_frame = self.n_m1
+        self.nvalide = {}
+
+    def alloca_frame(self):
+        f = self.next_frame
+        if f >= self.n_frame:
+            raise MemoryError("scenario does not fit in {} MiB".format(self.mem_mib))
+        self.next_frame += 1
+        return f * DIM_PAGINA
+
+    def _finish_frames(self):
+        img = self.img
+        vdf = bytearray(4 * self.n_frame)
+        free = list(range(self.next_frame, self.n_frame))
+        for i, f in enumerate(free):
+            nxt = free[i + 1] if i + 1 < len(free) else 0
+            struct.pack_into('<I', vdf, 4 * f, nxt)
+        for f, n in self.nvalide.items():
+            struct.pack_into('<H', vdf, 4 * f, n)
+        img.write(self.a_vdf, vdf)
+        img.write_q(self.a_n_m1, self.n_m1)
+        img.write_q(self.a_n_m2, self.n_frame - self.n_m1)
+        img.write_q(self.a_n_frame, self.n_frame)
+        img.write_q(self.a_primo, free[0] if free else 0)
+        img.write_q(self.a_num_liberi, len(free))
+
+    def new_table(self):
+        return self.alloca_frame()
+
+    def set_entry(self, tab, i, value):
+        old = struct.unpack('<Q', self.img.read(tab + i * 8, 8))[0]
+        if not old & BIT_P and value & BIT_P:
+            f = tab // DIM_PAGINA
+            self.nvalide[f] = self.nvalide.get(f, 0) + 1
+        self.img.write_q(tab + i * 8, value)
+
+    def map_page(self, root, vaddr, frame, flags, levels=1):
+        """map vaddr to frame in the tree rooted at root, with a page of the given level"""
+        tab = root
+        for liv in range(4, levels, -1):
+            i = (vaddr >> (12 + 9 * (liv - 1))) & 0x1ff
+            e = struct.unpack('<Q', self.img.read(tab + i * 8, 8))[0]
+            if not e & BIT_P:
+                sub = self.new_table()
+                self.set_entry(tab, i, sub | BIT_P | BIT_W | (flags & BIT_U))
+                e = sub
+            tab = e & ~0xfff
+        i = (vaddr >> (12 + 9 * (levels - 1))) & 0x1ff
+        self.set_entry(tab, i, frame | flags | (BIT_PS if levels > 1 else 0))
+
+    def _functions(self):
+        img = self.img
+        self.sys_funs = {}
+        for k, name in enumerate(('dummy', 'main_sistema', 'c_sem_wait', 'c_sem_signal', 'c_delay', 'salva_stato', 'carica_stato')):
+            self.sys_funs[name] = 0x100000 + k * 0x100
+            img.add_function(name, self.sys_funs[name], '/home/ce/nucleo/build/sistema')
+        self.utn_funs = []
+        for k in range(max(self.nproc, 1)):
+            a = 0xffff800000000000 + 0x1000 + k * 0x80
+            img.add_function('proc_body_{}'.format(k), a, '/home/ce/nucleo/build/utente')
+            self.utn_funs.append(a)
+
+    def _shared_tables(self):
+        """tables shared by every process: sistema/condiviso, IO/condiviso, utente/condiviso"""
+        img = self.img
+        self.shared = self.new_table()
+        # identity mapping of the whole physical memory: 4 KiB pages for the
+        # first 2 MiB (page 0 is left unmapped), 2 MiB pages for the rest
+        for p in range(1, 512):
+            self.map_page(self.shared, p * DIM_PAGINA, p * DIM_PAGINA, BIT_P | BIT_W | BIT_A)
+        for p in range(1, img.mem_tot // (2 * MiB)):
+            self.map_page(self.shared, p * 2 * MiB, p * 2 * MiB, BIT_P | BIT_W | BIT_A | BIT_D, levels=2)
+        io = 0x10000000000
+        for p in range(16):
+            self.map_page(self.shared, io + p * DIM_PAGINA, self.alloca_frame(), BIT_P | BIT_W | BIT_A)
+        utn = 0xffff800000000000
+        for p in range(32):
+            fl = BIT_P | BIT_U | BIT_A if p < 24 else BIT_P | BIT_U | BIT_W | BIT_A | BIT_D
+            self.map_page(self.shared, utn + p * DIM_PAGINA, self.alloca_frame(), fl)
+
+    def _new_space(self, user):
+        root = self.new_table()
+        for i in (0, 2) + tuple(range(256, 384)):
+            e = struct.unpack('<Q', self.img.read(self.shared + i * 8, 8))[0]
+            if e & BIT_P:
+                self.set_entry(root, i, e)
+        # system stack, at the top of sistema/privato
+        sstack = (2 << 39) - DIM_PAGINA
+        self.map_page(root, sstack, self.alloca_frame(), BIT_P | BIT_W | BIT_A | BIT_D)
+        if user:
+            # user heap at the start of utente/privato, user stack at its end
+            heap = 0xffffc00000000000
+            for p in range(self.pages):
+                fl = BIT_P | BIT_W | BIT_U
+                if (p // 16) % 3 == 1:
+                    fl |= BIT_A
+                elif (p // 16) % 3 == 2:
+                    fl |= BIT_A | BIT_D
+                self.map_page(root, heap + p * DIM_PAGINA, self.alloca_frame(), fl)
+            ustack = 0xfffffffffffff000
+            for p in range(4):
+                self.map_page(root, ustack - p * DIM_PAGINA, self.alloca_frame(), BIT_P | BIT_W | BIT_U | BIT_A | BIT_D)
+        return root, sstack
+
+    def _processes(self):
+        img, t = self.img, self.img.types
+        self.procs = {}
+        pids = []
+        dummy_prio = 0
+        for k in range(self.nproc):
+            user = k >= 2
+            pid = k + 1 if k else 0
+            root, sstack = self._new_space(user)
+            a = self._alloc(t['des_proc'].sizeof)
+            corpo = self.utn_funs[k] if user else self.sys_funs['dummy' if k == 0 else 'main_sistema']
+            contesto = [ (pid << 32) | (i * 0x11) for i in range(16) ]
+            saved = sstack + DIM_PAGINA - 5 * 8
+            contesto[4] = saved
+            prio = dummy_prio if k == 0 else 100 + k
+            blob = struct.pack('<HHIQ16QQI4xQQQ', pid, 3 if user else 0, prio, sstack + DIM_PAGINA,
+                               *contesto, root, 0xFFFFFFFF, 0, corpo, k)
+            img.write(a, blob)
+            # interrupt frame saved on the system stack
+            frame = self._v2p(root, saved)
+            rip = corpo + 0x10 + k
+            img.write(frame, struct.pack('<5Q', rip, 19 if user else 8, 0x202,
+                                          0xfffffffffffff000 - 8 * k if user else sstack, 27 if user else 0))
+            img.write_q(self.a_proc_table + 8 * pid, a)
+            self.procs[pid] = { 'addr': a, 'cr3': root, 'prio': prio, 'user': user }
+            pids.append(pid)
+        img.write(self.a_processi, struct.pack('<I', sum(1 for p in self.procs.values() if p['user'])))
+        img.write(self.a_dummy_prio, struct.pack('<I', dummy_prio))
+        return pids
+
+    def _v2p(self, root, vaddr):
+        tab = root
+        for liv in range(4, 0, -1):
+            i = (vaddr >> (12 + 9 * (liv - 1))) & 0x1ff
+            e = struct.unpack('<Q', self.img.read(tab + i * 8, 8))[0]
+            tab = e & ~0xfff
+        return tab | (vaddr & 0xfff)
+
+    def _link(self, pids, head_addr):
+        """chain the des_proc of pids through puntatore, head stored at head_addr"""
+        prev = None
+        for pid in pids:
+            a = self.procs[pid]['addr']
+            if prev is None:
+                self.img.write_q(head_addr, a)
+            else:
+                self.img.write_q(prev + 160, a)
+            prev = a
+        if prev is None:
+            self.img.write_q(head_addr, 0)
+        else:
+            self.img.write_q(prev + 160, 0)
+
+    def _queues(self, pids):
+        img = self.img
+        esec = pids[-1]
+        img.write_q(self.a_esecuzione, self.procs[esec]['addr'])
+        self.procs[esec]['addr']
+        rest = pids[:-1]
+        # a quarter is ready, a quarter is sleeping, the rest waits on semaphores
+        n = len(rest)
+        pronti = sorted(rest[:max(1, n // 4)], key=lambda p: -self.procs[p]['prio'])
+        sospesi = rest[max(1, n // 4):max(1, n // 2)]
+        waiting = rest[max(1, n // 2):]
+        self._link(pronti, self.a_pronti)
+        prev = None
+        for k, pid in enumerate(sospesi):
+            r = self._alloc(24)
+            img.write(r, struct.pack('<I4xQQ', 10 + k, 0, self.procs[pid]['addr']))
+            img.write_q(prev + 8 if prev else self.a_sospesi, r)
+            prev = r
+        if not sospesi:
+            img.write_q(self.a_sospesi, 0)
+        nsis = self.nsem // 4
+        img.write(self.a_sem_utn, struct.pack('<I', self.nsem))
+        img.write(self.a_sem_sis, struct.pack('<I', nsis))
+        sems = [ i for i in range(self.nsem) ] + [ 1024 + i for i in range(nsis) ]
+        queues = { s: [] for s in sems }
+        for k, pid in enumerate(waiting):
+            queues[sems[(k * 7) % len(sems)]].append(pid)
+        for s in sems:
+            q = queues[s]
+            a = self.a_array_dess + 16 * s
+            img.write(a, struct.pack('<i', -len(q) if q else s % 3))
+            self._link(q, a + 8)
+
+#endregion
@@ -0,0 +1,59 @@
+"""Record a memory image of a running nucleo, to be used by bench.py.
+
+Source this file in a gdb session connected to QEMU and stopped inside the
+nucleo (after util/start.gdb has set the convenience variables), then run
+
+    (gdb) nucleo-record <file>
+
+The image contains the whole physical memory (pages that only contain
+zeros are skipped), the types, global symbols and convenience variables
+used by vscode_nucleo.py, the registers, and the function symbols needed to
+decode the corpo and the saved rip of every process.
+"""
+
+import os
+import sys
+
+import gdb
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import image
+from nucleo_snapshot import record_meta, record_functions
+
+zero_page = bytes(image.DIM_PAGINA)
+
+#region Memory
+
+def read_pages(qemu, mem_tot):
+    """read the physical memory (identity mapped by the nucleo), one page at a time"""
+    pages = {}
+    for f in range(mem_tot // image.DIM_PAGINA):
+        try:
+            page = bytes(qemu.read_memory(f * image.DIM_PAGINA, image.DIM_PAGINA))
+        except gdb.MemoryError:
+            continue
+        if page != zero_page:
+            pages[f] = page
+    return pages
+
+#endregion
+
+class NucleoRecord(gdb.Command):
+    """Record the state of the nucleo into an image file for bench.py.
+Usage: nucleo-record <file>"""
+
+    def __init__(self):
+        super(NucleoRecord, self).__init__("nucleo-record", gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) != 1:
+            raise gdb.GdbError("usage: nucleo-record <file>")
+
+        meta = record_meta()
+        pages = read_pages(gdb.selected_inferior(), meta['mem_tot'])
+        meta['functions'] = record_functions(pages, meta)
+        image.write_image(argv[0], meta, pages)
+        gdb.write("{}: {} pages, {} functions\n".format(argv[0], len(pages), len(meta['functions'])))
+
+NucleoRecord()
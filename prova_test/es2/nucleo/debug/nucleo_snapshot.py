@@ -0,0 +1,215 @@
+"""Describe the state of a stopped nucleo and save it to a snapshot file.
+
+Used by the NucleoSave command of vscode_nucleo.py, and by the tools of the
+bench directory (record.py records whole images with the same description,
+image.py loads both back into the stand-in gdb module).
+
+The description covers everything but the memory: the types, global symbols
+and convenience variables looked up by vscode_nucleo.py, the registers, and
+the function symbols needed to decode the corpo and the saved rip of every
+process. A snapshot file holds it together with the pages given by the caller.
+"""
+
+import json
+import struct
+
+import gdb
+
+DIM_PAGINA = 4096
+
+# names looked up by vscode_nucleo.py
+record_types = [ 'des_proc', 'des_sem', 'richiesta', 'des_frame', 'unsigned long', 'void' ]
+record_symbols = [ 'proc_table', 'processi', 'esecuzione', 'pronti', 'array_dess',
+                   'sem_allocati_utente', 'sem_allocati_sistema', 'sospesi', 'vdf',
+                   'N_M1', 'N_M2', 'N_FRAME', 'primo_frame_libero', 'num_frame_liberi',
+                   'DUMMY_PRIORITY' ]
+record_convenience = [ 'MAX_LIV', 'MAX_SEM', 'SEL_CODICE_SISTEMA', 'SEL_CODICE_UTENTE', 'SEL_DATI_UTENTE',
+                       'MAX_PROC', 'MAX_PRIORITY', 'MIN_PRIORITY',
+                       'I_SIS_C', 'I_SIS_P', 'I_MIO_C', 'I_UTN_C', 'I_UTN_P' ]
+record_registers = [ 'cr3', 'cr0', 'cs', 'rip', 'eflags', 'rax', 'rcx', 'rdx', 'rbx',
+                     'rsp', 'rbp', 'rsi', 'rdi', 'r8', 'r9', 'r10', 'r11', 'r12',
+                     'r13', 'r14', 'r15' ]
+
+zero_page = bytes(DIM_PAGINA)
+
+#region Types
+
+# type codes are saved by name, since their values depend on the gdb version
+TYPE_CODES = {
+    'ptr': gdb.TYPE_CODE_PTR, 'array': gdb.TYPE_CODE_ARRAY, 'struct': gdb.TYPE_CODE_STRUCT,
+    'union': gdb.TYPE_CODE_UNION, 'enum': gdb.TYPE_CODE_ENUM, 'func': gdb.TYPE_CODE_FUNC,
+    'int': gdb.TYPE_CODE_INT, 'void': gdb.TYPE_CODE_VOID, 'bool': gdb.TYPE_CODE_BOOL,
+}
+TYPE_CODE_NAMES = { v: k for k, v in TYPE_CODES.items() }
+
+def type_is_signed(t):
+    """true if t is a signed integer type"""
+    t = t.strip_typedefs()
+    try:
+        return t.is_signed
+    except AttributeError:
+        # gdb < 12
+        return t.code == gdb.TYPE_CODE_INT and not (t.name or '').startswith('unsigned')
+
+def type_ref(t, types):
+    """describe t as a name, or as a JSON object for the unnamed types, adding the named types it uses to types"""
+    s = t.strip_typedefs()
+    if s.code == gdb.TYPE_CODE_PTR:
+        return { 'ptr': type_ref(s.target(), types) }
+    if s.code == gdb.TYPE_CODE_ARRAY:
+        return { 'array': type_ref(s.target(), types), 'n': s.range()[1] + 1 }
+    name = t.name or s.name
+    if name is None:
+        return type_json(s, None, types)
+    if name not in types:
+        # placeholder, in case the type refers to itself
+        types[name] = None
+        types[name] = type_json(s, name, types)
+    return name
+
+def type_json(s, name, types):
+    code = TYPE_CODE_NAMES.get(s.code)
+    if code is None:
+        raise gdb.GdbError("cannot record type {}".format(s))
+    d = { 'name': name, 'code': code, 'sizeof': s.sizeof, 'signed': type_is_signed(s) }
+    if s.code in (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION):
+        d['fields'] = [ [f.name, f.bitpos, type_ref(f.type, types)] for f in s.fields()
+                        if hasattr(f, 'bitpos') ]
+    return d
+
+#endregion
+
+#region Code addresses
+
+def readq(pages, addr):
+    page = pages.get(addr // DIM_PAGINA, zero_page)
+    return struct.unpack_from('<Q', page, addr % DIM_PAGINA)[0]
+
+def v2p(pages, tab, addr, max_liv):
+    for liv in range(max_liv, 0, -1):
+        e = readq(pages, tab + ((addr >> (12 + 9 * (liv - 1))) & 0x1ff) * 8)
+        if not e & 1:
+            return None
+        if liv > 1 and e & 0x80:
+            return (e & ~((1 << (12 + 9 * (liv - 1))) - 1) & 0x000ffffffffff000) | (addr & ((1 << (12 + 9 * (liv - 1))) - 1))
+        tab = e & 0x000ffffffffff000
+    return tab | (addr & 0xfff)
+
+def code_addresses(pages, symbols, types, registers, max_liv):
+    """corpo and saved rip of every process, plus the current rip"""
+    addrs = set()
+    if 'rip' in registers:
+        addrs.add(registers['rip'])
+    if 'proc_table' not in symbols:
+        return addrs
+    table, ref = symbols['proc_table']
+    n = ref['n']
+    fields = { f[0]: f[1] // 8 for f in types['des_proc']['fields'] }
+    for pid in range(n):
+        p = readq(pages, table + 8 * pid)
+        if not p:
+            continue
+        addrs.add(readq(pages, p + fields['corpo']))
+        # the interrupt frame is at the top of the saved stack
+        stack = v2p(pages, readq(pages, p + fields['cr3']), readq(pages, p + fields['contesto'] + 4 * 8), max_liv)
+        if stack is not None:
+            addrs.add(readq(pages, stack))
+    addrs.discard(0)
+    return addrs
+
+def function_of(addr):
+    """(name, start, objfile) of the function containing addr, or None"""
+    try:
+        b = gdb.block_for_pc(addr)
+    except RuntimeError:
+        return None
+    while b is not None and b.function is None:
+        b = b.superblock
+    if b is None:
+        return None
+    objfile = gdb.current_progspace().solib_name(addr) or b.function.symtab.objfile.filename
+    return (b.function.name.split('(')[0], b.start, objfile)
+
+#endregion
+
+def record_meta():
+    """everything but the memory: types, symbols, constants, convenience variables and registers"""
+    types = {}
+    for n in record_types:
+        type_ref(gdb.lookup_type(n), types)
+
+    symbols = {}
+    constants = {}
+    for n in record_symbols:
+        try:
+            v = gdb.parse_and_eval(n)
+        except gdb.error:
+            gdb.write("warning: symbol {} not found\n".format(n))
+            continue
+        if v.address is None:
+            constants[n] = int(v)
+        else:
+            symbols[n] = [ int(v.address), type_ref(v.type, types) ]
+
+    convenience = {}
+    for n in record_convenience:
+        v = gdb.parse_and_eval('$' + n)
+        if v.type.code != gdb.TYPE_CODE_VOID:
+            convenience[n] = int(v)
+
+    registers = {}
+    for r in record_registers:
+        try:
+            registers[r] = int(gdb.parse_and_eval('$' + r)) & 0xffffffffffffffff
+        except gdb.error:
+            pass
+
+    return {
+        'mem_tot': int(gdb.parse_and_eval('N_FRAME')) * DIM_PAGINA,
+        'types': types,
+        'symbols': symbols,
+        'constants': constants,
+        'convenience': convenience,
+        'registers': registers,
+    }
+
+def record_functions(pages, meta):
+    """the function symbols needed to decode the code addresses found in pages"""
+    functions = {}
+    for a in code_addresses(pages, meta['symbols'], meta['types'], meta['registers'], meta['convenience'].get('MAX_LIV', 4)):
+        f = function_of(a)
+        if f is not None:
+            functions[f[1]] = f
+    return [ functions[s] for s in sorted(functions) ]
+
+#region Snapshot files
+
+# A header, the frame numbers of the pages, the pages themselves and the JSON
+# description of everything else (see record_meta). The index and the pages
+# start at page boundaries, so that the file can be mapped in memory and every
+# page used in place.
+SNAPSHOT_MAGIC = b'NUCLEOSS'
+SNAPSHOT_VERSION = 1
+# magic, version, page size, number of pages, offset of the index, of the pages, of the JSON, length of the JSON
+snapshot_header = struct.Struct('<8sIIQQQQQ')
+
+def page_align(n):
+    return (n + DIM_PAGINA - 1) // DIM_PAGINA * DIM_PAGINA
+
+def write_snapshot(path, meta, pages):
+    """Write a snapshot file. pages maps frame numbers to the content of the frame."""
+    frames = sorted(pages)
+    meta_json = json.dumps(dict(meta, version=SNAPSHOT_VERSION)).encode('utf-8')
+    index_off = DIM_PAGINA
+    data_off = page_align(index_off + 8 * len(frames))
+    meta_off = data_off + DIM_PAGINA * len(frames)
+    with open(path, 'wb') as f:
+        header = snapshot_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, DIM_PAGINA, len(frames),
+                                      index_off, data_off, meta_off, len(meta_json))
+        f.write(header.ljust(index_off, b'\0'))
+        f.write(struct.pack('<{}Q'.format(len(frames)), *frames).ljust(data_off - index_off, b'\0'))
+        for fr in frames:
+            f.write(bytes(pages[fr]))
+        f.write(meta_json)
+
+#endregion
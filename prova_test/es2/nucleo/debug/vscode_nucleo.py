@@ -1,4 +1,5 @@
 import re
+import os
 import sys
 import gdb
 import gdb.printing
@@ -6,8 +7,24 @@ import struct
 import fcntl
 import termios
 import json
+import base64
+import hashlib
+import tempfile
+import shutil
+import atexit
+from collections import OrderedDict, deque
+from itertools import compress, repeat
+from operator import and_, ne
 from gdb.FrameDecorator import FrameDecorator
 
+# the modules next to this file, which gdb sources without adding it to the path
+try:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+except NameError:
+    # sourced by .gdbinitvscode from the directory of the nucleo
+    sys.path.insert(0, 'debug')
+import nucleo_snapshot
+
 #region Variables and constants
 try:
     max_liv  = int(gdb.parse_and_eval('MAX_LIV'))
@@ -20,7 +37,25 @@ cs_cur = 0
 wp_cur = 0
 MEM_TREE = []
 vm_last = 0xffff
-past_tables = set()
+vm_run = None
+vm_flags_ids = {}
+maps_tables = set()
+tree_tables = set()
+vm_tables = {}
+vm_snapshots = OrderedDict()
+vm_events = []
+vm_seen_maps = []
+vm_seen_tree = []
+vm_seen_tables = []
+vm_skips = 0
+vm_memo = {}
+vm_memo_generation = None
+vm_shared_tables = None
+vm_shared_generation = None
+rmap = None
+rmap_generation = None
+vm_history = OrderedDict()
+vm_history_raw = {}
 
 flags  = { 1: 'W', 2: 'U', 3: 'w', 4: 'c', 5: 'A', 6: 'D', 7: 's' }
 nflags = { 1: 'R', 2: 'S', 3: '-', 4: '-', 5: '-', 6: '-', 7: '-' }
@@ -62,6 +97,32 @@ void_ptr_type = gdb.Type.pointer(gdb.lookup_type('void'))
 # cache the inferior
 qemu = gdb.selected_inferior()
 
+# cache the address of the process table, read as a single block of pointers
+proc_table_addr = int(gdb.parse_and_eval('&proc_table').cast(ulong_type))
+proc_table_struct = struct.Struct('<{}Q'.format(max_proc))
+
+# cache the address of the semaphore descriptors, read in blocks of allocated entries
+array_dess_addr = int(gdb.parse_and_eval('&array_dess').cast(ulong_type))
+
+# cache the addresses of the heads of the queues, read as raw pointers
+pronti_addr = int(gdb.parse_and_eval('&pronti').cast(ulong_type))
+sospesi_addr = int(gdb.parse_and_eval('&sospesi').cast(ulong_type))
+esecuzione_addr = int(gdb.parse_and_eval('&esecuzione').cast(ulong_type))
+
+# cache the addresses of the counters (natl) read at every stop
+natl_struct = struct.Struct('<I')
+processi_addr = int(gdb.parse_and_eval('&processi').cast(ulong_type))
+sem_allocati_utente_addr = int(gdb.parse_and_eval('&sem_allocati_utente').cast(ulong_type))
+sem_allocati_sistema_addr = int(gdb.parse_and_eval('&sem_allocati_sistema').cast(ulong_type))
+
+# cache the addresses of the frame descriptors and of the frame counters (natq),
+# so that the physical memory can be decoded without evaluating anything
+n_frame = int(gdb.parse_and_eval('N_FRAME'))
+vdf_addr = int(gdb.parse_and_eval('&vdf').cast(ulong_type))
+n_m1_addr = int(gdb.parse_and_eval('&N_M1').cast(ulong_type))
+primo_frame_libero_addr = int(gdb.parse_and_eval('&primo_frame_libero').cast(ulong_type))
+num_frame_liberi_addr = int(gdb.parse_and_eval('&num_frame_liberi').cast(ulong_type))
+
 for i, p in enumerate(m_parts):
     tr = { 'sis': 'sistema', 'mio': 'IO', 'utn': 'utente' }
     r, c = m_parts[i].split('_')
@@ -70,9 +131,144 @@ m_ini.append(256)
 
 #endregion
 
+#region Memory cache
+
+# Physical pages read from qemu during the current stop, in LRU order.
+# The content of the memory can only change while the target is running
+# (or when gdb itself writes to it), so the cache is dropped on every stop
+# and selectively on memory_changed.
+page_size = 4096
+page_cache_max = 2048
+page_cache = OrderedDict()
+page_cache_stats = { 'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0 }
+
+# Memory generation: bumped every time the cached memory is invalidated, so
+# that clients can tell whether a previous snapshot is still current.
+mem_generation = 0
+
+def readpage(frame):
+    """return the content of physical page number frame, reading it from qemu only once per stop"""
+    page = page_cache.get(frame)
+    if page is not None:
+        page_cache.move_to_end(frame)
+        page_cache_stats['hits'] += 1
+        return page
+
+    page_cache_stats['misses'] += 1
+    page = bytes(qemu.read_memory(frame * page_size, page_size))
+    page_cache[frame] = page
+    if len(page_cache) > page_cache_max:
+        page_cache.popitem(last=False)
+        page_cache_stats['evictions'] += 1
+    return page
+
+def readmem(addr, size):
+    """read size bytes at physical address addr through the page cache"""
+    try:
+        frame, off = divmod(addr, page_size)
+        if off + size <= page_size:
+            return readpage(frame)[off:off + size]
+        chunks = []
+        while size > 0:
+            n = min(size, page_size - off)
+            chunks.append(readpage(frame)[off:off + n])
+            size -= n
+            frame += 1
+            off = 0
+        return b"".join(chunks)
+    except gdb.MemoryError:
+        # the page is only partially readable (e.g. at the end of the
+        # physical memory): read just what was asked for, uncached
+        return bytes(qemu.read_memory(addr, size))
+
+def invalidate_page_cache(event=None):
+    global mem_generation
+    page_cache.clear()
+    page_cache_stats['invalidations'] += 1
+    mem_generation += 1
+
+def memory_changed(event):
+    global mem_generation
+    mem_generation += 1
+    first = event.address // page_size
+    last = (event.address + max(event.length, 1) - 1) // page_size
+    for frame in range(first, last + 1):
+        page_cache.pop(frame, None)
+
+gdb.events.stop.connect(invalidate_page_cache)
+gdb.events.inferior_call_post.connect(invalidate_page_cache)
+gdb.events.memory_changed.connect(memory_changed)
+
+class NucleoStats(gdb.Command):
+
+    def __init__(self):
+        super(NucleoStats, self).__init__("NucleoStats", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        out = {}
+        out['page_cache'] = dict(page_cache_stats, size=len(page_cache), max=page_cache_max)
+        out['symbols'] = dict(symbol_cache_stats, size=len(symbol_cache))
+        out['tlb'] = dict(tlb_stats, size=len(tlb), paging=len(tlb_paging))
+        out['fragments'] = dict(fragment_cache_stats, size=len(fragment_cache), bytes=fragment_cache_bytes, max_bytes=fragment_cache_bytes_max)
+        for stats in out.values():
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+        gdb.write(json.dumps(out) + "\n")
+
+NucleoStats()
+
+class NucleoGeneration(gdb.Command):
+    """Print the current memory generation as JSON: outputs obtained
+in the same generation are still current."""
+
+    def __init__(self):
+        super(NucleoGeneration, self).__init__("NucleoGeneration", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        gdb.write(json.dumps({ 'generation': mem_generation }) + "\n")
+
+NucleoGeneration()
+
+#endregion
+
 #region Utility functions
 
+# address -> (function, module), valid until the symbol files change
+symbol_cache = {}
+symbol_cache_stats = { 'hits': 0, 'misses': 0, 'invalidations': 0 }
+
+def invalidate_symbol_cache(event=None):
+    symbol_cache.clear()
+    symbol_cache_stats['invalidations'] += 1
+
+gdb.events.new_objfile.connect(invalidate_symbol_cache)
+gdb.events.clear_objfiles.connect(invalidate_symbol_cache)
+
 def resolve_function(f):
+    r = symbol_cache.get(f)
+    if r is not None:
+        symbol_cache_stats['hits'] += 1
+        return r
+    symbol_cache_stats['misses'] += 1
+    r = lookup_function(f)
+    symbol_cache[f] = r
+    return r
+
+def lookup_function(f):
+    # use the debug info if f is the start of a function...
+    try:
+        b = gdb.block_for_pc(f)
+    except RuntimeError:
+        b = None
+    while b is not None and b.function is None:
+        b = b.superblock
+    if b is not None and b.start == f:
+        sym = b.function
+        fun = sym.name.split('(')[0]
+        mod = gdb.current_progspace().solib_name(f) or sym.symtab.objfile.filename
+        return (fun, os.path.basename(mod))
+
+    # ...otherwise ask gdb for the nearest symbol
     global res_sym
     s = gdb.execute('info symbol 0x{:x}'.format(f), False, True)
     m = res_sym.match(s)
@@ -94,7 +290,154 @@ def toi(v):
 
 def readfis(addr):
     """read an unsigned long from qemu memory"""
-    return struct.unpack('Q', bytes(qemu.read_memory(addr, 8)))[0]
+    return struct.unpack('Q', readmem(addr, 8))[0]
+
+def readnatl(addr):
+    """read a natl from qemu memory"""
+    return natl_struct.unpack(readmem(addr, natl_struct.size))[0]
+
+# a page table: 512 entries of 8 bytes, decoded in a single unpack
+tab_entries = 512
+tab_struct = struct.Struct('<{}Q'.format(tab_entries))
+
+def readtab(addr):
+    """read all the entries of the page table at addr with a single memory transfer"""
+    return tab_struct.unpack(readmem(addr, tab_struct.size))
+
+def readtab_hashed(addr):
+    """read the page table at addr, returning (content hash, entries)"""
+    raw = readmem(addr, tab_struct.size)
+    return (hashlib.blake2b(raw, digest_size=16).digest(), tab_struct.unpack(raw))
+
+int_formats = { 1: 'B', 2: 'H', 4: 'I', 8: 'Q' }
+
+def scalar_format(t):
+    """struct format of a scalar (integer or pointer) type, or None"""
+    t = t.strip_typedefs()
+    if t.code == gdb.TYPE_CODE_PTR:
+        return 'Q'
+    if t.code in (gdb.TYPE_CODE_INT, gdb.TYPE_CODE_ENUM, gdb.TYPE_CODE_BOOL) and t.sizeof in int_formats:
+        f = int_formats[t.sizeof]
+        return f.lower() if nucleo_snapshot.type_is_signed(t) else f
+    return None
+
+def named_fields(type, bitpos=0):
+    """(name, bitpos, bitsize, type) of the fields of a struct, the ones of its anonymous structs and unions included"""
+    for f in type.fields():
+        t = f.type.strip_typedefs()
+        if f.name is None and t.code in (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION):
+            yield from named_fields(t, bitpos + f.bitpos)
+        else:
+            yield (f.name, bitpos + f.bitpos, f.bitsize, f.type)
+
+class StructLayout:
+    """
+    Decoder for the raw bytes of a struct, built once from the field offsets
+    of its gdb.Type. Scalar fields and arrays of scalars are unpacked by a
+    single precompiled struct.Struct (arrays as tuples); any other field,
+    or one overlapping a previous field in a union, is returned as a gdb.Value
+    built from its bytes, without touching the target.
+    """
+
+    def __init__(self, type):
+        self.type = type
+        self.size = type.sizeof
+        self.fields = {}
+        fmt = '<'
+        pos = 0
+        self.unpacked = []
+        self.others = []
+        self.scalars = {}
+        self.columns = {}
+        for name, bitpos, bitsize, ftype in sorted(named_fields(type), key=lambda f: f[1]):
+            if name is None or bitsize:
+                continue
+            off = bitpos // 8
+            self.fields[name] = (off, ftype)
+
+            # arrays of scalars are unpacked as tuples
+            t = ftype.strip_typedefs()
+            is_array = t.code == gdb.TYPE_CODE_ARRAY
+            count = 0
+            if is_array:
+                t = t.target()
+                count = ftype.sizeof // t.sizeof if t.sizeof else 0
+
+            # a scalar can always be read alone, even if it overlaps another field
+            sf = scalar_format(t)
+            if sf is not None and not is_array:
+                self.scalars[name] = (off, struct.Struct('<' + sf))
+            if sf is None or off < pos or (is_array and not count):
+                self.others.append((name, off, ftype))
+                continue
+
+            if off > pos:
+                fmt += "{}x".format(off - pos)
+            fmt += "{}{}".format(count, sf) if count else sf
+            self.unpacked.append((name, count))
+            pos = off + ftype.sizeof
+        self.struct = struct.Struct(fmt)
+
+    def decode(self, raw):
+        """return a dictionary with the value of every named field in raw"""
+        values = self.struct.unpack_from(raw)
+        out = {}
+        k = 0
+        for name, n in self.unpacked:
+            if n:
+                out[name] = values[k:k + n]
+                k += n
+            else:
+                out[name] = values[k]
+                k += 1
+        for name, off, t in self.others:
+            out[name] = gdb.Value(raw[off:off + t.sizeof], t)
+        return out
+
+    def read(self, addr):
+        """decode the struct at addr with a single memory transfer"""
+        return self.decode(readmem(addr, self.size))
+
+    def read_array(self, addr, count):
+        """decode count consecutive structs starting at addr with a single memory transfer"""
+        raw = readmem(addr, count * self.size) if count else b''
+        return [ self.decode(raw[i * self.size:(i + 1) * self.size]) for i in range(count) ]
+
+    def read_field(self, addr, name):
+        """read only the scalar field name of the struct at addr"""
+        off, s = self.scalars[name]
+        return s.unpack(readmem(addr + off, s.size))[0]
+
+    def read_column(self, addr, count, name):
+        """
+        read only the scalar field name of count consecutive structs starting
+        at addr, with a single memory transfer and a single unpack
+        """
+        if not count:
+            return ()
+        column = self.column(count, name)
+        return column.unpack(readmem(addr, column.size))
+
+    def column(self, count, name):
+        """struct.Struct unpacking the scalar field name of count consecutive structs"""
+        key = (name, count)
+        column = self.columns.get(key)
+        if column is None:
+            off, s = self.scalars[name]
+            f = s.format.lstrip('<')
+            column = struct.Struct('<{}x'.format(off) + '{}{}x'.format(f, self.size - s.size) * (count - 1) + f)
+            self.columns[key] = column
+        return column
+
+def field_to_str(v, t):
+    """format a field decoded by StructLayout the way gdb prints it"""
+    if isinstance(v, int):
+        return str(gdb.Value(v).cast(t))
+    if isinstance(v, tuple):
+        # an array of scalars: print it from its bytes, as gdb prints arrays (and strings)
+        raw = struct.pack('<{}{}'.format(len(v), scalar_format(t.strip_typedefs().target())), *v)
+        return str(gdb.Value(raw, t))
+    return str(v)
 
 registers = [ 'rax', 'rcx', 'rdx', 'rbx', 'rsp', 'rbp', 'rsi', 'rdi', 'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15' ]
 def show_registers():
@@ -105,18 +448,249 @@ def show_registers():
     gdb.write('RFLAGS: {}\n'.format(gdb.parse_and_eval('$eflags')))
     #gdb.execute('print $eflags')
 
+# Software TLB, valid for one memory generation:
+#   tlb:        (cr3, virtual page number) -> translation (see tlb_walk)
+#   tlb_paging: (cr3, level, vaddr >> shift of the level) -> (table of that level, entries, rights)
+#               the intermediate levels, shared by the translations of close addresses
+tlb = {}
+tlb_paging = {}
+tlb_generation = None
+tlb_stats = { 'hits': 0, 'misses': 0 }
+
+# physical address bits of a tab entry
+paddr_mask = 0x000ffffffffff000
+
+def tlb_walk(cr3, vaddr):
+    """
+    Walk the translation tree rooted at cr3 for vaddr, starting from the
+    deepest intermediate level already known. Returns a tuple:
+        (physical page address or None if vaddr is not mapped,
+         mask of the offset in the page,
+         entries met from the root down,
+         P, W and U bits of the whole path, NX of the whole path)
+    """
+    # start from the deepest table already known for this address
+    tab, liv, entries, rights, nx = cr3, max_liv, (), 0x7, 0
+    for l in range(1, max_liv):
+        known = tlb_paging.get((cr3, l, vaddr >> (12 + 9 * l)))
+        if known is not None:
+            tab, entries, rights, nx = known
+            liv = l
+            break
+
+    while True:
+        shift = 12 + (liv - 1) * 9
+        e = readfis(tab + ((vaddr >> shift) & 0x1ff) * 8)
+        entries += (e,)
+        rights &= e & 0x7
+        nx |= e >> 63
+        if not e & 1:
+            return (None, 0, entries, 0, nx)
+        if liv == 1 or e & (1 << 7):
+            mask = (1 << shift) - 1
+            return ((e & paddr_mask) & ~mask, mask, entries, rights, nx)
+        tab = e & paddr_mask
+        liv -= 1
+        tlb_paging[(cr3, liv, vaddr >> (12 + 9 * liv))] = (tab, entries, rights, nx)
+
+def tlb_translate(cr3, vaddr):
+    """translate vaddr in the address space rooted at cr3 through the software TLB (see tlb_walk)"""
+    global tlb, tlb_paging, tlb_generation
+
+    # the tables may have changed
+    if tlb_generation != mem_generation:
+        tlb = {}
+        tlb_paging = {}
+        tlb_generation = mem_generation
+
+    key = (cr3, vaddr >> 12)
+    t = tlb.get(key)
+    if t is not None:
+        tlb_stats['hits'] += 1
+        return t
+    tlb_stats['misses'] += 1
+    t = tlb[key] = tlb_walk(cr3, vaddr)
+    return t
+
 def v2p(tab, addr):
     """translate addr in the vm of proc"""
-    for i in range(max_liv, 0, -1):
-        #gdb.write("--> tab{} @ {:16x}\n".format(i, tab))
-        shift = 12 + (i - 1) * 9
-        addr2 = tab + ((addr >> shift) & 0x1ff) * 8
-        #gdb.write("--> ent{} @ {:16x}\n".format(i, addr2))
-        entry = readfis(addr2)
-        if not (entry & 0x1):
-            return None
-        tab = entry & ~0xfff
-    return tab | (addr & 0xfff)
+    paddr, mask = tlb_translate(toi(tab), addr)[:2]
+    if paddr is None:
+        return None
+    return paddr | (addr & mask)
+
+def parse_options(arg, flags=(), values=()):
+    """
+    Split the argument of a command into options and positional arguments.
+        flags:  names of the options without a value ('--name')
+        values: names of the options followed by a value ('--name <value>')
+    Returns (options, args), where options maps the name of each given option
+    to True or to its value.
+    """
+    argv = gdb.string_to_argv(arg)
+    options = {}
+    args = []
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        name = a[2:]
+        if a.startswith('--') and name in flags:
+            options[name] = True
+        elif a.startswith('--') and name in values:
+            if i + 1 >= len(argv):
+                raise gdb.GdbError("option {} requires a value".format(a))
+            i += 1
+            options[name] = argv[i]
+        elif a.startswith('--'):
+            raise gdb.GdbError("unknown option {}".format(a))
+        else:
+            args.append(a)
+        i += 1
+    return (options, args)
+
+# directory of the outputs written with '--file', created on first use with
+# mkdtemp (so it is private to this user) and removed when gdb exits; only
+# the last output_files_max files are kept in it
+output_dir = None
+output_files = deque()
+output_files_max = 16
+
+def write_output(name, data, options):
+    """
+    Write the JSON text data. With the 'file' option, it is written to a new
+    file named after name, and only a handle to it is printed:
+        {"file": <path>, "generation": <memory generation>, "length": <bytes>}
+    Every output gets its own file, so concurrent requests never read each
+    other's output; the file is complete when the handle is printed.
+    """
+    global output_dir
+
+    if not options.get('file'):
+        gdb.write(data + "\n")
+        return
+
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix="vscode-nucleo-")
+        atexit.register(shutil.rmtree, output_dir, True)
+    data = data.encode()
+    fd, path = tempfile.mkstemp(dir=output_dir, prefix=name + "-", suffix=".json")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+    except BaseException:
+        os.unlink(path)
+        raise
+
+    output_files.append(path)
+    while len(output_files) > output_files_max:
+        try:
+            os.unlink(output_files.popleft())
+        except FileNotFoundError:
+            # already removed by the reader
+            pass
+    gdb.write(json.dumps({ 'file': path, 'generation': mem_generation, 'length': len(data) }) + "\n")
+
+# JSON outputs of the commands computed in the current memory generation,
+# keyed by command name and options, and the requests to compute again
+# as soon as the target stops (see precompute_outputs)
+output_cache = {}
+output_cache_generation = None
+output_requests = {}
+
+def cached_output(cmd, options, remember=True):
+    """
+    Return the JSON output of cmd.compute(options), computing it only once
+    per memory generation. Unless remember is false, the request is
+    remembered, to be computed in advance at the next stop.
+    """
+    global output_cache, output_cache_generation
+
+    if output_cache_generation != mem_generation:
+        output_cache = {}
+        output_cache_generation = mem_generation
+
+    # the destination of the output does not change its content
+    options = { k: v for k, v in options.items() if k != 'file' }
+    key = (cmd.name, tuple(sorted(options.items())))
+    if key not in output_cache:
+        output_cache[key] = encode_output(cmd.compute(options))
+    if remember:
+        output_requests[key] = (cmd, options)
+    return output_cache[key]
+
+# JSON fragments of the parts of the outputs that only depend on some raw bytes
+# (a page table and the tables below it, a des_proc), keyed by their content hash:
+# unlike the outputs, they survive across memory generations, while the bytes they
+# come from do not change. They are kept in LRU order, within a budget of about
+# fragment_cache_bytes_max bytes, and inserted as is by encode_output.
+fragment_cache_bytes_max = 32 << 20
+fragment_cache_bytes = 0
+fragment_cache = OrderedDict()
+fragment_cache_stats = { 'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0 }
+
+class JsonFragment:
+    """
+    JSON text already encoded, written as is in place of this object by
+    encode_output. A fragment in a list may hold several elements.
+    """
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+def fragment_get(key):
+    """return the value cached for key, or None"""
+    f = fragment_cache.get(key)
+    if f is None:
+        fragment_cache_stats['misses'] += 1
+        return None
+    fragment_cache.move_to_end(key)
+    fragment_cache_stats['hits'] += 1
+    return f[1]
+
+def fragment_put(key, f, size):
+    """cache f, taking about size bytes, for key, evicting the least recently used values over the budget"""
+    global fragment_cache_bytes
+
+    old = fragment_cache.pop(key, None)
+    if old is not None:
+        fragment_cache_bytes -= old[0]
+    fragment_cache[key] = (size, f)
+    fragment_cache_bytes += size
+    while fragment_cache_bytes > fragment_cache_bytes_max and len(fragment_cache) > 1:
+        fragment_cache_bytes -= fragment_cache.popitem(last=False)[1][0]
+        fragment_cache_stats['evictions'] += 1
+    return f
+
+def invalidate_fragments(event=None):
+    global fragment_cache_bytes
+
+    # the fragments contain the names of the symbols
+    fragment_cache.clear()
+    fragment_cache_bytes = 0
+    fragment_cache_stats['invalidations'] += 1
+
+gdb.events.new_objfile.connect(invalidate_fragments)
+gdb.events.clear_objfiles.connect(invalidate_fragments)
+
+# a JsonFragment is first encoded as a string holding its index
+fragment_marker = re.compile(r'"\\u0000fragment(\d+)"')
+
+def encode_output(obj):
+    """json.dumps of obj, with the text of every JsonFragment in it joined in place"""
+    fragments = []
+    def placeholder(f):
+        if not isinstance(f, JsonFragment):
+            raise TypeError("{} is not JSON serializable".format(type(f).__name__))
+        fragments.append(f.text)
+        return "\0fragment{}".format(len(fragments) - 1)
+
+    text = json.dumps(obj, default=placeholder)
+    if not fragments:
+        return text
+    parts = fragment_marker.split(text)
+    parts[1::2] = [ fragments[int(i)] for i in parts[1::2] ]
+    return "".join(parts)
 
 def write_key(k, v, indent=0):
     gdb.write("{}{:16s}: {}\n".format(" " * indent, k, v))
@@ -166,6 +740,12 @@ def dump_selector(sel):
         name = "sconosciuto"
     return "[{}]".format(name)
 
+# layouts of des_proc, des_sem, richiesta and des_frame, to decode them from their raw bytes
+des_proc_layout = StructLayout(des_proc_type)
+des_sem_layout = StructLayout(des_sem_type)
+richiesta_layout = StructLayout(richiesta_type)
+des_frame_layout = StructLayout(gdb.lookup_type('des_frame'))
+
 res_sym = re.compile('^(\w+)(?:\(.*\))? in section \.text(?: of .*/(.*))?$')
 
 def is_curproc(p):
@@ -174,10 +754,10 @@ def is_curproc(p):
 
 def get_process(pid):
     """convert from pid to des_proc *"""
-    p = gdb.parse_and_eval('proc_table[{}]'.format(pid))
-    if p == gdb.Value(0):
+    p = readfis(proc_table_addr + 8 * pid)
+    if not p:
         return None
-    return p
+    return gdb.Value(p).cast(des_proc_ptr_type)
 
 def dump_corpo(proc):
     c = proc['corpo']
@@ -189,47 +769,90 @@ def dump_corpo(proc):
 
 #region Process functions
 
+# saved by the interrupt mechanism on the system stack: rip, cs, rflags, rsp, ss
+int_frame_struct = struct.Struct('<5Q')
+
 def process_dump(pid, proc):
+    """proc is a des_proc decoded by des_proc_layout"""
     proc_dmp = {}
     proc_dmp['pid'] = pid
-    proc_dmp['livello'] ="utente" if proc['livello'] == gdb.Value(3) else "sistema"
+    proc_dmp['livello'] ="utente" if proc['livello'] == 3 else "sistema"
     proc_dmp['corpo'] = dump_corpo(proc)
-    vstack = toi(proc['contesto'][4])
-    stack = v2p(toi(proc['cr3']), vstack)
-    rip = readfis(stack)
+    vstack = proc['contesto'][4]
+    stack = v2p(proc['cr3'], vstack)
+    rip, cs, rflags, rsp, ss = int_frame_struct.unpack(readmem(stack, int_frame_struct.size))
     rip_s = "{}".format(gdb.Value(rip).cast(void_ptr_type)).split()
     proc_dmp['rip'] = "{:>18s} {}".format(rip_s[0], " ".join(rip_s[1:]))
     pila_dmp = {}
     pila_dmp['start'] = "{:016x} \u279e {:x}):\n".format(vstack, stack)
-    pila_dmp['cs'] =  dump_selector(readfis(stack + 8))
-    pila_dmp['rflags'] = dump_flags(readfis(stack + 16))  
-    pila_dmp['rsp'] = "{:#18x}".format(readfis(stack + 24)) 
-    pila_dmp['ss'] = dump_selector(readfis(stack + 32)) 
+    pila_dmp['cs'] =  dump_selector(cs)
+    pila_dmp['rflags'] = dump_flags(rflags)
+    pila_dmp['rsp'] = "{:#18x}".format(rsp)
+    pila_dmp['ss'] = dump_selector(ss)
     proc_dmp['pila_dmp'] = pila_dmp  
     
     reg_dmp ={}
     for i, r in enumerate(registers):
-        reg_dmp[r] = hex(toi(proc['contesto'][i]))
+        reg_dmp[r] = hex(proc['contesto'][i])
     proc_dmp['reg_dmp'] = reg_dmp  
 
-    cr3 = toi(proc['cr3'])
+    cr3 = proc['cr3']
     proc_dmp['cr3'] = vm_paddr_to_str(cr3)
 
     if len(toshow) > 0:
         campi_aggiuntivi = {}
         for f in toshow:
-            campi_aggiuntivi[f.name] = str(proc[f]),
+            campi_aggiuntivi[f.name] = field_to_str(proc[f.name], f.type),
         proc_dmp['campi_aggiuntivi'] = campi_aggiuntivi  
     
     return proc_dmp
 
-def process_list():
-    for pid in range(max_proc):
-        p = get_process(pid)
-        if p is None:
-            continue
-        proc = p.dereference()
-        yield (pid, proc)
+# the output of process_dump can be cached only if it depends on the bytes of the
+# des_proc and of the interrupt frame alone: not if a field is shown by following a pointer
+process_fragments = not any(f.type.strip_typedefs().code == gdb.TYPE_CODE_PTR for f in toshow)
+
+def process_fragment(pid, addr):
+    """
+    process_dump of the des_proc at addr as a JsonFragment, encoded again only
+    if the bytes of the des_proc or of the interrupt frame on its stack changed
+    """
+    raw = readmem(addr, des_proc_layout.size)
+    key = ('proc', pid, hashlib.blake2b(raw, digest_size=16).digest())
+    cached = fragment_get(key)
+    if cached is not None:
+        cr3, vstack, stack, frame, f = cached
+        # the same des_proc, but its stack may have been remapped or written
+        if v2p(cr3, vstack) == stack and readmem(stack, int_frame_struct.size) == frame:
+            return f
+    proc = des_proc_layout.decode(raw)
+    f = JsonFragment(json.dumps(process_dump(pid, proc)))
+    cr3, vstack = proc['cr3'], proc['contesto'][4]
+    stack = v2p(cr3, vstack)
+    frame = readmem(stack, int_frame_struct.size)
+    return fragment_put(key, (cr3, vstack, stack, frame, f), len(f.text) + len(frame))[4]
+
+def process_summary(pid, proc, queues):
+    """the fields of a des_proc that are cheap to compute, plus the queue it is in"""
+    proc_dmp = {}
+    proc_dmp['pid'] = pid
+    proc_dmp['livello'] ="utente" if proc['livello'] == 3 else "sistema"
+    proc_dmp['corpo'] = dump_corpo(proc)
+    proc_dmp['coda'] = queues.get(pid)
+    return proc_dmp
+
+def process_table():
+    """return the (pid, des_proc address) of every live process"""
+    # read the whole proc_table at once and only look at the live slots
+    proc_table = proc_table_struct.unpack(readmem(proc_table_addr, proc_table_struct.size))
+    return [ (pid, proc_table[pid]) for pid in compress(range(max_proc), proc_table) ]
+
+def process_list(procs=None):
+    """yield (pid, des_proc) for every process in procs (default: all live processes),
+    each des_proc decoded with a single memory transfer"""
+    if procs is None:
+        procs = process_table()
+    for pid, addr in procs:
+        yield (pid, des_proc_layout.read(addr))
 
 def parse_process(a):
         if not a:
@@ -253,44 +876,47 @@ def parse_process(a):
             raise TypeError("expression must be a (pointer to) des_proc or a process id")
         return p
 
-def sem_list(lvl='all'):
+def sem_ranges(lvl='all'):
+    """(first index, count) of the allocated semaphores of level lvl ('utn', 'sis' or 'all')"""
+    ranges = []
     if(lvl != 'sis'):
-        sem_utn = gdb.parse_and_eval("sem_allocati_utente")
-        for i in range(sem_utn):
-            s = gdb.parse_and_eval("array_dess[{}]".format(i))
-            yield (i, s)
-
+        ranges.append((0, readnatl(sem_allocati_utente_addr)))
     if(lvl != 'utn'):
-        sem_sis = gdb.parse_and_eval("sem_allocati_sistema")
-        for i in range(sem_sis):
-            s = gdb.parse_and_eval("array_dess[{}]".format(i + max_sem))
-            yield (i + max_sem, s)
+        ranges.append((max_sem, readnatl(sem_allocati_sistema_addr)))
+    return ranges
 
-def show_list_custom_cast(list_name, field, next_elem, cast_function):
+def sem_list(lvl='all', cond='all'):
+    """
+    yield (index, des_sem) for the allocated semaphores of level lvl ('utn', 'sis' or 'all'),
+    reading each range of allocated descriptors with a single memory transfer.
+    With cond == 'waiting', only the semaphores with a non-empty waiting queue are returned.
+    """
+    for base, n in sem_ranges(lvl):
+        sems = des_sem_layout.read_array(array_dess_addr + base * des_sem_layout.size, n)
+        for i, s in enumerate(sems):
+            if cond == 'waiting' and not s['pointer']:
+                continue
+            yield (i + base, s)
+
+def show_list_raw(head, field, next_elem, cast_function):
+    """
+    follow a list of des_proc starting from the address head, reading only
+    the field and next_elem of each element from raw memory
+    """
     proc_info_list = []
-    proc = gdb.parse_and_eval(list_name)
     past_proc = set()
 
-    while proc != gdb.Value(0):
-
-        # Check that list is not recursive
-        if int(proc.address) in past_proc:
-            break
-
-        # add element to list of visited elements    
-        past_proc.add(int(proc.address))
-
-        # access the process struct
-        proc = proc.dereference()
-        
-        # add the process field data to the list
-        proc_info_list.append(cast_function(proc[field]))
-        
-        # fetch the next process
-        proc = proc[next_elem]
+    # stop at the end of the list, or if the list is recursive
+    while head and head not in past_proc:
+        past_proc.add(head)
+        proc_info_list.append(cast_function(des_proc_layout.read_field(head, field)))
+        head = des_proc_layout.read_field(head, next_elem)
 
     return proc_info_list
 
+def show_list_custom_cast(list_name, field, next_elem, cast_function):
+    return show_list_raw(toi(gdb.parse_and_eval(list_name)), field, next_elem, cast_function)
+
 
 def Esecuzione():
     exec_pointer = gdb.parse_and_eval('esecuzione')
@@ -313,6 +939,34 @@ def Pronti():
     """
     return show_list_custom_cast('pronti', 'id', 'puntatore', int)
 
+def sospesi_requests(direct=False):
+    """
+    yield the address of every richiesta of the sospesi list, stopping if the
+    list is recursive; with direct, the words are read bypassing the page cache
+    (see read_word)
+    """
+    if direct:
+        request = read_word(sospesi_addr, ulong_struct)
+    else:
+        request = readfis(sospesi_addr)
+    past_request = set()
+
+    while request and request not in past_request:
+        past_request.add(request)
+        yield request
+        if direct:
+            request = read_field_direct(richiesta_layout, request, 'p_rich')
+        else:
+            request = richiesta_layout.read_field(request, 'p_rich')
+
+def sospesi_list():
+    """
+    yield the richiesta of the sospesi list, each decoded from raw memory
+    with a single transfer, stopping if the list is recursive
+    """
+    for request in sospesi_requests():
+        yield richiesta_layout.read(request)
+
 def Sospesi():
     """
     Returns a JSON array containing infomation on 'sospesi' list,
@@ -327,40 +981,25 @@ def Sospesi():
     ]
     """
     request_list = []
-    request = gdb.parse_and_eval("sospesi")
     attesa_tot = 0
-    past_request = set()
 
-    while request != gdb.Value(0):
-
-        # check that list is not recursive
-        if int(request.address) in past_request:
-            break
-
-        # add the element to visited elements
-        past_request.add(int(request.address))
-
-        # access the request struct
-        request = request.dereference()
+    for request in sospesi_list():
 
         # retrieve request data
         request_data = {}
-        attesa = int(request['d_attesa'])
+        attesa = request['d_attesa']
         request_data["attesa_relativa"] = attesa
         attesa_tot = attesa_tot + attesa
         request_data["attesa_totale"] = attesa_tot
 
-        request_data["process"] = int(request['pp'].dereference()['id'])
+        request_data["process"] = des_proc_layout.read_field(request['pp'], 'id')
         
         # add the request data to the list
         request_list.append(request_data)
-        
-        # fetch the next request
-        request = request['p_rich']
 
     return request_list
 
-def Semaphore():
+def Semaphore(cond='all'):
     """
     Returns a JSON array containing infomation on semaphores,
     structured as:
@@ -386,28 +1025,21 @@ def Semaphore():
                 ...
             ]
     }
+    With cond == 'waiting', only the semaphores with a non-empty waiting queue are included.
     """
     
     sem_sis = []
     sem_utn = []
 
-    # User semaphore
-    for i, s in sem_list('utn'):
-        sem = {}
-        sem['index'] = i
-        sem['sem_info'] = {}
-        sem['sem_info']['counter'] = int(s['counter'])
-        sem['sem_info']['process_list'] = show_list_custom_cast("array_dess[{}].pointer".format(i), 'id', 'puntatore', int)
-        sem_utn.append(sem)
-
-    # System semaphore
-    for i, s in sem_list('sis'):
-        sem = {}
-        sem['index'] = i
-        sem['sem_info'] = {}
-        sem['sem_info']['counter'] = int(s['counter'])
-        sem['sem_info']['process_list'] = show_list_custom_cast("array_dess[{}].pointer".format(i), 'id', 'puntatore', int)
-        sem_sis.append(sem)
+    for lvl, sems in (('utn', sem_utn), ('sis', sem_sis)):
+        for i, s in sem_list(lvl, cond):
+            sem = {}
+            sem['index'] = i
+            sem['sem_info'] = {}
+            sem['sem_info']['counter'] = s['counter']
+            # only follow the waiting queue if there is one
+            sem['sem_info']['process_list'] = show_list_raw(s['pointer'], 'id', 'puntatore', int) if s['pointer'] else []
+            sems.append(sem)
     
     arr = {
         'utente': sem_utn,
@@ -416,27 +1048,270 @@ def Semaphore():
 
     return arr
 
-def Processes():
+def ProcessQueues(out):
+    """
+    Map the pid of every queued process to the name of its queue
+    ("esecuzione", "pronti", "sospesi" or "sem[<index>]"), given the
+    queues already computed by ProcessAll.
+    """
+    queues = {}
+    if out['exec'] != 'empty':
+        queues[out['exec']] = 'esecuzione'
+    for pid in out['pronti']:
+        queues[pid] = 'pronti'
+    for r in out['sospesi']:
+        queues[r['process']] = 'sospesi'
+    for lvl in ('utente', 'sistema'):
+        for sem in out['semaphore'][lvl]:
+            for pid in sem['sem_info']['process_list']:
+                queues[pid] = 'sem[{}]'.format(sem['index'])
+    return queues
+
+def Processes(procs=None, queues=None):
+    """
+    Dump the processes in procs (default: all live processes).
+    If queues is given, only a summary of each process is produced
+    (see process_summary).
+    """
+    if queues is None and process_fragments:
+        if procs is None:
+            procs = process_table()
+        return [ process_fragment(pid, addr) for pid, addr in procs ]
+
     arr = []
-    for pid, proc in process_list():
-        arr.append(process_dump(pid, proc))
+    for pid, proc in process_list(procs):
+        if queues is None:
+            arr.append(process_dump(pid, proc))
+        else:
+            arr.append(process_summary(pid, proc, queues))
     return arr
 
 class ProcessAll(gdb.Command):
+    """Dump the process queues, the semaphores and the live processes as JSON.
+With '--summary', only pid, livello, corpo and queue of each process are shown
+(use ProcessDetail for the rest), and the running process is dumped in full in
+'exec_detail'. With '--waiting', only the semaphores with a
+non-empty waiting queue are shown. '--offset <n>' and '--limit <n>' select a
+page of the live processes; 'total' is always the number of live processes.
+With '--file', the JSON is written to a temporary file and only a handle to
+it is printed."""
+
+    name = "ProcessAll"
+    flags = ('summary', 'waiting', 'file')
+    values = ('offset', 'limit')
+    usage = "usage: ProcessAll [--summary] [--waiting] [--offset <n>] [--limit <n>] [--file]"
 
     def __init__(self):
-        super(ProcessAll, self).__init__("ProcessAll", gdb.COMMAND_DATA)
+        super(ProcessAll, self).__init__(self.name, gdb.COMMAND_DATA)
 
     def invoke(self, arg, from_tty):
+        options, args = parse_options(arg, self.flags, self.values)
+        if args:
+            raise gdb.GdbError(self.usage)
+        self.page(options)
+        write_output(self.name, cached_output(self, options), options)
+
+    def page(self, options):
+        """(offset, limit or None) of the '--offset <n>' and '--limit <n>' options"""
+        try:
+            offset = int(options.get('offset', 0))
+            limit = int(options['limit']) if 'limit' in options else None
+        except ValueError:
+            raise gdb.GdbError(self.usage)
+        if offset < 0 or (limit is not None and limit < 0):
+            raise gdb.GdbError(self.usage)
+        return (offset, limit)
+
+    def compute(self, options):
         out = {}
         out['exec'] = Esecuzione()
         out['pronti'] = Pronti()
         out['sospesi'] = Sospesi()
-        out['semaphore'] = Semaphore()
-        out['processes'] = Processes()
-        gdb.write(json.dumps(out) + "\n")
+        out['semaphore'] = Semaphore('waiting' if options.get('waiting') else 'all')
+
+        procs = process_table()
+        out['total'] = len(procs)
+        offset, limit = self.page(options)
+        if limit is not None:
+            procs = procs[offset:offset + limit]
+        else:
+            procs = procs[offset:]
 
-ProcessAll()
+        queues = ProcessQueues(out) if options.get('summary') else None
+        out['processes'] = Processes(procs, queues)
+
+        # a summary is always shown with the running process in full
+        if options.get('summary') and out['exec'] != 'empty':
+            addr = readfis(proc_table_addr + 8 * out['exec'])
+            if process_fragments:
+                out['exec_detail'] = process_fragment(out['exec'], addr)
+            else:
+                out['exec_detail'] = process_dump(out['exec'], des_proc_layout.read(addr))
+        return out
+
+process_all = ProcessAll()
+
+class ProcessDetail(gdb.Command):
+    """Dump all the information about one process as JSON.
+The argument can be any expression returning a process id."""
+
+    def __init__(self):
+        super(ProcessDetail, self).__init__("ProcessDetail", gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+
+    def invoke(self, arg, from_tty):
+        if not arg:
+            arg = 'esecuzione->id'
+        pid = int(gdb.parse_and_eval(arg))
+        p = get_process(pid) if 0 <= pid < max_proc else None
+        if p is None:
+            raise gdb.GdbError("no such process")
+        proc = des_proc_layout.read(toi(p))
+        gdb.write(json.dumps(process_dump(pid, proc)) + "\n")
+
+ProcessDetail()
+
+#endregion
+
+#region Scheduler breakpoints
+
+ulong_struct = struct.Struct('<Q')
+
+def read_word(addr, s):
+    """read a single value with format s directly from qemu, bypassing the page cache"""
+    return s.unpack(bytes(qemu.read_memory(addr, s.size)))[0]
+
+def read_field_direct(layout, addr, name):
+    """read only the scalar field name of the struct at addr, bypassing the page cache"""
+    off, s = layout.scalars[name]
+    return read_word(addr + off, s)
+
+def list_length(head, next_elem, limit):
+    """length of the list of des_proc starting at head, counting at most up to limit"""
+    past_proc = set()
+    while head and head not in past_proc and len(past_proc) < limit:
+        past_proc.add(head)
+        head = read_field_direct(des_proc_layout, head, next_elem)
+    return len(past_proc)
+
+def sospesi_pids():
+    """the pids of the processes in the sospesi list"""
+    return set(read_field_direct(des_proc_layout, read_field_direct(richiesta_layout, request, 'pp'), 'id')
+               for request in sospesi_requests(direct=True))
+
+class NucleoBreakpoint(gdb.Breakpoint):
+    """
+    A breakpoint that only stops when a predicate on the state of the nucleo holds.
+    The predicate (check) is evaluated in Python on the few words of raw memory it
+    needs, read directly from qemu, without parsing any expression, so that the
+    target goes on as fast as possible when it is false.
+    """
+
+    def __init__(self, spec):
+        super(NucleoBreakpoint, self).__init__(spec)
+
+    def stop(self):
+        try:
+            reason = self.check()
+        except gdb.MemoryError:
+            # the structures are not readable (yet): better to stop and let the user see
+            reason = "the nucleo structures are not readable"
+        if not reason:
+            return False
+        # the target has been running since the memory was cached
+        invalidate_page_cache()
+        gdb.write("{}\n".format(reason))
+        return True
+
+    def check(self):
+        """None, or the reason to stop"""
+        return None
+
+class ProntiBreakpoint(NucleoBreakpoint):
+    """stop when the pronti list has more than n processes"""
+
+    def __init__(self, spec, n):
+        self.n = n
+        super(ProntiBreakpoint, self).__init__(spec)
+
+    def check(self):
+        # only the first n + 1 processes are needed
+        if list_length(read_word(pronti_addr, ulong_struct), 'puntatore', self.n + 1) > self.n:
+            return "pronti has more than {} processes".format(self.n)
+        return None
+
+class SemaphoreBreakpoint(NucleoBreakpoint):
+    """stop when the waiting queue of semaphore sem is not empty"""
+
+    def __init__(self, spec, sem):
+        self.pointer_addr = array_dess_addr + sem * des_sem_layout.size + des_sem_layout.scalars['pointer'][0]
+        self.sem = sem
+        super(SemaphoreBreakpoint, self).__init__(spec)
+
+    def check(self):
+        if read_word(self.pointer_addr, ulong_struct):
+            return "semaphore {} has waiting processes".format(self.sem)
+        return None
+
+class SospesiBreakpoint(NucleoBreakpoint):
+    """stop when a process (process pid, if not None) enters the sospesi list"""
+
+    def __init__(self, spec, pid=None):
+        self.pid = pid
+        # the processes already waiting do not enter the list
+        try:
+            self.waiting = sospesi_pids()
+        except gdb.MemoryError:
+            self.waiting = set()
+        super(SospesiBreakpoint, self).__init__(spec)
+
+    def check(self):
+        waiting = sospesi_pids()
+        entered = waiting - self.waiting
+        self.waiting = waiting
+        if self.pid is not None:
+            entered &= { self.pid }
+        if entered:
+            return "process {} entered sospesi".format(", ".join(str(p) for p in sorted(entered)))
+        return None
+
+class NucleoBreak(gdb.Command):
+    """Set a breakpoint that stops only when the state of the scheduler matches.
+Usage: NucleoBreak pronti <n> [--at <location>]
+       NucleoBreak sem <index> [--at <location>]
+       NucleoBreak sospesi [<pid>] [--at <location>]
+'pronti' stops when the pronti list has more than <n> processes, 'sem' when
+the waiting queue of semaphore <index> is not empty, 'sospesi' when a process
+(or process <pid>) enters the sospesi list. The condition is checked every time
+<location> is reached (default: schedulatore), in Python and on raw memory."""
+
+    name = "NucleoBreak"
+    flags = ()
+    values = ('at',)
+    usage = "usage: NucleoBreak pronti <n> | sem <index> | sospesi [<pid>] [--at <location>]"
+
+    def __init__(self):
+        super(NucleoBreak, self).__init__(self.name, gdb.COMMAND_BREAKPOINTS)
+
+    def invoke(self, arg, from_tty):
+        options, args = parse_options(arg, self.flags, self.values)
+        spec = options.get('at', 'schedulatore')
+        kind, params = (args[0], args[1:]) if args else (None, [])
+        try:
+            params = [ int(gdb.parse_and_eval(a)) for a in params ]
+        except gdb.error:
+            raise gdb.GdbError(self.usage)
+
+        if kind == 'pronti' and len(params) == 1:
+            bp = ProntiBreakpoint(spec, params[0])
+        elif kind == 'sem' and len(params) == 1 and 0 <= params[0] < 2 * max_sem:
+            bp = SemaphoreBreakpoint(spec, params[0])
+        elif kind == 'sospesi' and len(params) <= 1:
+            bp = SospesiBreakpoint(spec, params[0] if params else None)
+        else:
+            raise gdb.GdbError(self.usage)
+        gdb.write("Breakpoint {} ({}) at {}\n".format(bp.number, " ".join(args), spec))
+
+NucleoBreak()
 
 #endregion
 
@@ -468,41 +1343,48 @@ def vm_access_byte_to_str(a):
         fl.append("D")
     return " ".join(fl)
 
-def vm_dump_map(v, a):
-    '''
-    Prints info on virtual address
-    Parameters:
-        v:      virtual address, composed as array of tab entries
-        a:      access bits
-    '''
-
-    global MEM_MAPS # stores all data to be printed
-    global current_part
-
-    # make sure to always display 12 oct address (so #max_liv table/frame indexes, usually 4 elements)
-    vv = v[:]
-    while len(vv) < max_liv:
-        vv.append(0)
-
-    # virtual address mapping path
-    vs = []
-
-    # check if address is Utente (last half) or Sistema (first half)
-    if vv[0] >= 0x100:
-        addr = 0xffff
-        vs.append("U")
-    else:
-        addr = 0
-        vs.append("S")
-
-    # compose the pyhsical address
+def vm_effective_access(a, table, cur):
+    """
+    Access bits of an entry as seen along the path that reaches it
+        a:      access bits of the entry (12 LSBs)
+        table:  whether the entry is in a table above the bottom level
+        cur:    access bits of the path that reaches the table
+    """
+    # if not bottom level (levels 4, 3, 2) and PS bit = 0, A and D bits are meaningless
+    if table and not a & (1 << 7):
+        a &= ~(1 << 5)  # A
+        a &= ~(1 << 6)  # D
+    # R/W: a read only path makes the entry read only
+    if not cur & (1 << 1):
+        a &= ~(1 << 1)
+    # U/S: a system path makes the entry system
+    if not cur & (1 << 2):
+        a &= ~(1 << 2)
+    return a
+
+# everything that depends only on the access bits of an entry is computed once, for all
+# the 4096 possible values, so that a whole table can be decoded with table lookups:
+#   vm_access_str:  the description used by the vm maps
+#   vm_tree_flags:  the flags string used by the vm tree
+#   vm_effective:   the effective access bits, for each level kind and R/W, U/S bits of the path
+#   vm_is_table:    whether an entry above the bottom level points to another table
+vm_access_str = [ vm_access_byte_to_str(a) for a in range(4096) ]
+vm_tree_flags = [ "".join(flags[j] if a & (1 << j) else nflags[j] for j in flags) for a in range(4096) ]
+vm_effective = { (table, cur): [ vm_effective_access(a, table, cur) for a in range(4096) ]
+                 for table in (False, True) for cur in (0, 2, 4, 6) }
+vm_is_table = bytes(1 if a & 1 and not a & (1 << 7) else 0 for a in range(4096))
+vm_octal = [ "{:03o}".format(i) for i in range(tab_entries) ]
+
+def vm_addr_to_str(lin):
+    """format a linear address of the translation tree as a canonical 64 bit address"""
     # nb: sys mem is mapped at the bottom, so we add 0xffff at the beginning of the address
-    for i in range(max_liv):
-        addr = (addr << 9) | vv[i]
-        vs.append("{:03o}".format(vv[i]))
+    if lin & (1 << (12 + 9 * max_liv - 1)):
+        lin |= ~((1 << (12 + 9 * max_liv)) - 1) & 0xffffffffffffffff
+    return "{:016x}".format(lin)
 
-    # final shift to account for frame dimension
-    addr <<= 12
+def vm_flags_id(a):
+    """id of the access bits a in the shared flags list of the vm maps"""
+    global vm_flags_ids
 
     # access type
     col = "R W"
@@ -513,206 +1395,422 @@ def vm_dump_map(v, a):
     elif (cs_cur or wp_cur) and not a & (1 << 1):
         col = "R"
 
-    # format address as (a string of) 16 hexadecimal numbers
-    addr = ("{:016x}".format(addr))
-    
-    # append info to global array
-    add_info = {}
-    add_info['a'] = addr
-    add_info['x'] = vm_access_byte_to_str(a)
-    add_info['o'] = "-".join(vs)
-    add_info['t'] = col
-    MEM_MAPS[current_part]['info'].append(add_info)
-
-def vm_show_maps_rec(tab, liv, virt, cur):
+    key = (vm_access_str[a], col)
+    if key not in vm_flags_ids:
+        vm_flags_ids[key] = len(vm_flags_ids)
+    return vm_flags_ids[key]
+
+def vm_run_close(end):
+    """end the current run of the vm maps at the linear address end (excluded)"""
+    global vm_run
+
+    if vm_run is None:
+        return
+    start, fid = vm_run
+    vm_run = None
+    if end > start:
+        MEM_MAPS[current_part]['runs'].append([ vm_addr_to_str(start), vm_addr_to_str(end - 1), (end - start) >> 12, fid ])
+
+def vm_virt_to_lin(v):
+    """linear address of a path of tab entries indexes, missing levels are zeroes"""
+    lin = 0
+    for i, x in enumerate(v):
+        lin |= x << (12 + 9 * (max_liv - 1 - i))
+    return lin
+
+def vm_dump_map(lin, a):
     '''
-        tab:    table address
-        liv:    table level
-        virt:   array of previous tab entries (composing the path)
-        cur:    current access control bits (to check for U/S and R/W rights among the entire path)
+    Starts a new run of the vm maps at a virtual address
+    Parameters:
+        lin:    linear address
+        a:      access bits
     '''
-    global vm_last, m_ini, max_liv, current_part, MEM_MAPS, past_tables
 
-    # check that mempry tree is not recursive
-    if tab in past_tables:
-        return
+    global vm_run
 
-    past_tables.add(tab)
+    vm_run_close(lin)
+    vm_run = (lin, vm_flags_id(a))
 
+def vm_map_entry(lin, a):
+    '''
+    Visits a frame entry of the vm maps: a new run starts if its access
+    bits differ from the last printed space. Every visit is logged in
+    vm_events, so that a memoised subtree can be visited again (see vm_walk)
+        lin:    linear address of the entry
+        a:      effective access bits of the entry
+    '''
 
-    # counter to keep track of memory area (listed in m_names)
-    cur_reg = 0
+    global vm_last
 
-    # loop over all page entries
-    for i in range(512):
+    vm_events.append((lin, a))
+    if a != vm_last:
+        # start a new run of the virtual address space
+        vm_dump_map(lin, a)
+        # update access bit information on the last printed space
+        vm_last = a
+
+def vm_part_start(k):
+    '''
+    Starts memory part k (listed in m_names) of the vm maps: the run in progress
+    is split at the boundary, so that every part describes all of its addresses
+    '''
+
+    global MEM_MAPS, current_part, vm_run
+
+    lin = m_ini[k] << (12 + 9 * (max_liv - 1))
+    run = vm_run
+    vm_run_close(lin)
+
+    # inizialize new dictionary for memory part
+    MEM_MAPS[k] = {}
+    MEM_MAPS[k]['part'] = m_names[k]
+    MEM_MAPS[k]['runs'] = []
+    current_part = k
+
+    if run is not None:
+        vm_run = (lin, run[1])
+
+def vm_tree_entry(i, e):
+    '''
+    Builds the vm_tree node of a present tab entry
+        i:      tab entry index
+        e:      tab entry
+    '''
+
+    # append entry and info
+    tab = {}
+    tab_entry_data = {}
+    # o - octal (tab entry index)
+    tab_entry_data['o'] = vm_octal[i]
+    # x - access (a string with all access info)
+    tab_entry_data['x'] = vm_tree_flags[e & 0xFFF]
+    # a - address (next table / frame address, all access bits zeroed)
+    tab_entry_data['a'] = "0x{:08x}".format(e & ~0xFFF)
+    # i - info
+    tab['i'] = tab_entry_data
+    # s - sub list
+    tab['s'] = []
+    return tab
+
+def vm_leaf_fragment(digest, entries):
+    """
+    (JsonFragment of the vm_tree nodes, or None if there are none, frames mapped)
+    of a bottom level table, whose bytes have the given digest
+    """
+    key = ('leaf', digest)
+    cached = fragment_get(key)
+    if cached is not None:
+        return cached
+    present = list(compress(range(tab_entries), map(and_, entries, repeat(1))))
+    tab_nodes = list(map(vm_tree_entry, present, map(entries.__getitem__, present)))
+    frames = [ e & ~0xfff for e in map(entries.__getitem__, present) if not e & (1 << 7) ]
+    f = JsonFragment(json.dumps(tab_nodes)[1:-1]) if tab_nodes else None
+    return fragment_put(key, (f, frames), (len(f.text) if f else 0) + 8 * len(frames))
+
+def vm_subtree_fragment(liv, cur, tables, nodes):
+    """
+    JsonFragment of the vm_tree nodes of a subtree of level liv, whose tables are
+    tables in the order of the walk: nodes is encoded again only if their bytes changed
+    """
+    h = hashlib.blake2b(bytes((liv, cur & 6)), digest_size=16)
+    for t in tables:
+        h.update(vm_tables[t][0])
+    key = ('tree', h.digest())
+    f = fragment_get(key)
+    if f is None:
+        f = JsonFragment(encode_output(nodes)[1:-1])
+        fragment_put(key, f, len(f.text))
+    return f
+
+def vm_walk_reset():
+    """start a new walk of a translation tree (the memoised subtrees survive while the memory does not change)"""
+    global maps_tables, tree_tables, vm_tables, vm_events, vm_seen_maps, vm_seen_tree, vm_seen_tables, vm_skips, vm_memo, vm_memo_generation
+
+    if vm_memo_generation != mem_generation:
+        vm_memo = {}
+        vm_memo_generation = mem_generation
+    maps_tables = set()
+    tree_tables = set()
+    vm_tables = {}
+    vm_events = []
+    vm_seen_maps = []
+    vm_seen_tree = []
+    vm_seen_tables = []
+    vm_skips = 0
+
+def vm_memo_replay(memo, vm_list):
+    """visit again a subtree memoised by vm_walk, as if it had been walked"""
+    nodes, events, tables, seen_maps, seen_tree = memo
+    vm_list.extend(nodes)
+    for lin, a in events:
+        vm_map_entry(lin, a)
+    vm_tables.update(tables)
+    vm_seen_tables.extend(tables)
+    maps_tables.update(seen_maps)
+    vm_seen_maps.extend(seen_maps)
+    tree_tables.update(seen_tree)
+    vm_seen_tree.extend(seen_tree)
+
+def vm_walk(tab, liv, virt, cur, vm_list, maps=True, tree=True):
+    '''
+    Visits a table once, producing both its vm maps regions and its vm tree entries
+        tab:        table address
+        liv:        table level
+        virt:       array of previous tab entries (composing the path)
+        cur:        current access control bits (to check for U/S and R/W rights among the entire path)
+        vm_list:    list where the vm tree entries of this table are appended
+        maps:       whether this table contributes to the vm maps
+        tree:       whether this table contributes to the vm tree
+
+    The subtrees below the root are memoised for the current memory generation,
+    by physical table address, so that the tables shared by several address
+    spaces (e.g. the sistema and IO parts) are decoded only once.
+    '''
+    global vm_skips
+
+    # check that memory tree is not recursive:
+    # the maps and the tree keep track of visited tables separately
+    if (maps and tab in maps_tables) or (tree and tab in tree_tables):
+        vm_skips += 1
+    maps = maps and tab not in maps_tables
+    tree = tree and tab not in tree_tables
+    if not maps and not tree:
+        return
+
+    # a subtree already walked, at the same address and with the same rights, can be
+    # visited again as long as none of its tables has been visited in this walk
+    lin = vm_virt_to_lin(virt)
+    key = (tab, liv, cur & 6, lin, maps, tree)
+    memo = vm_memo.get(key) if liv < max_liv else None
+    if memo is not None and maps_tables.isdisjoint(memo[3]) and tree_tables.isdisjoint(memo[4]):
+        vm_memo_replay(memo, vm_list)
+        return
+    start = (len(vm_list), len(vm_events), len(vm_seen_maps), len(vm_seen_tree), vm_skips, len(vm_seen_tables))
+
+    if maps:
+        maps_tables.add(tab)
+        vm_seen_maps.append(tab)
+    if tree:
+        tree_tables.add(tab)
+        vm_seen_tree.append(tab)
+
+    # fetch the whole table at once, remembering the ones in the tree for later deltas
+    if tree:
+        vm_tables[tab] = readtab_hashed(tab)
+        vm_seen_tables.append(tab)
+        entries = vm_tables[tab][1]
+    else:
+        entries = readtab(tab)
+
+    # effective access bits of all the entries, one table lookup each
+    acc = list(map(vm_effective[liv > 1, cur & 6].__getitem__, map(and_, entries, repeat(0xfff))))
+
+    # entries pointing to a lower level table
+    subtabs = set(compress(range(tab_entries), map(vm_is_table.__getitem__, acc))) if liv > 1 else set()
+
+    # if entry is paged, it appears in the tree
+    nodes = {}
+    if tree and liv > 1:
+        present = list(compress(range(tab_entries), map(and_, entries, repeat(1))))
+        tab_nodes = list(map(vm_tree_entry, present, map(entries.__getitem__, present)))
+        vm_list.extend(tab_nodes)
+        nodes = dict(zip(present, tab_nodes))
+    elif tree:
+        # the nodes of a bottom level table only depend on its bytes
+        f, frames = vm_leaf_fragment(vm_tables[tab][0], entries)
+        if f is not None:
+            vm_list.append(f)
+        # a frame seen from the bottom level is not visited again by the tree
+        tree_tables.update(frames)
+        vm_seen_tree.extend(frames)
+
+    # the entries that need a visit, in order: the tables, and for the maps the
+    # start of each memory part (at root level) and every entry whose access bits
+    # may differ from the last printed space (those after a change or a table)
+    visit = set(subtabs)
+    parts = {}
+    if maps:
+        visit.add(0)
+        visit.update(compress(range(1, tab_entries), map(ne, acc[1:], acc[:-1])))
+        visit.update(i + 1 for i in subtabs if i + 1 < tab_entries)
+        if liv == max_liv:
+            # m_ini stores the (intial) address of each memory part
+            parts = { m_ini[k]: k for k in range(len(m_ini) - 1) }
+            visit.update(parts)
+
+    for i in sorted(visit):
+
+        if i in parts:
+            vm_part_start(parts[i])
 
-        # if we are at root table (max_liv)
-        # m_ini stores the (intial) address of each memory part 
-        if liv == max_liv and cur_reg < len(m_ini) and i == m_ini[cur_reg]:
-            # inizialize new dictionary for memory part
-            MEM_MAPS[cur_reg] = {}
-            MEM_MAPS[cur_reg]['part'] = m_names[cur_reg]
-            MEM_MAPS[cur_reg]['info'] = []
-            current_part = cur_reg
-            cur_reg += 1
-        
-        # get i-th tab entry
-        e = readfis(tab + i * 8)
-
-        # get access control bits (12 LSBs)
-        a = e & 0xfff
-
-        # if not top level (levels 4, 3, 2) and PS bit = 0
-        if liv > 1 and not a & (1 << 7):
-            # reset A and D bits
-            a &= ~(1 << 5)  # A
-            a &= ~(1 << 6)  # D
-
-        # R/W
-        # if current access bits have R/W bit = 0 (if Read only)
-        if not cur & (1 << 1):
-            # reset R/W bit in a
-            a &= ~(1 << 1)
-
-        # U/S
-        # if current access bits have U/S bit = 0 (if U)
-        if not cur & (1 << 2): 
-            # reset U/S bit in a
-            a &= ~(1 << 2)
-        
         # append current tab entry to the list
         virt.append(i)
-        
-        # if entry is mapped (P = 1), not top level and not frame address -> entry is table address
-        if a & 1 and liv > 1 and not a & (1 << 7):
+
+        a = acc[i]
+        if i in subtabs:
             # get table address
-            f = e & ~0xfff
+            f = entries[i] & ~0xfff
             # recursive call
-            vm_show_maps_rec(f, liv - 1, virt, a)
-        
-        # otherwise (entry is frame address),
-        # if access bits are different from last printed space
-        elif a != vm_last:
-            # print info of virtual address space
-            vm_dump_map(virt, a)
-            # update access bit information on the last printed space
-            vm_last = a
-        
-        # empty the virt array (recursive call, only empty current element)
-        virt.pop()
-
-def vm_decode(f, liv, vm_list, stop=max_liv, rngs=[range(512)]*max_liv):
-    # Slightly modified from original code:
-    #   - previous argument <indent> is removed (no formatting needed)
-    #   - previous argument <nonpresent> is always false
-
-    global past_tables
+            sub_list = []
+            vm_walk(f, liv - 1, virt, a, sub_list, maps, tree)
+            if i in nodes and sub_list:
+                nodes[i]['s'].append(sub_list)
 
-    # check that memory tree is not recursive
-    if f in past_tables:
-        return
-        
-    past_tables.add(f)
-
-    if liv > 0 and stop > 0:
-
-        # swipe all tab entries
-        for i in rngs[liv - 1]:
-
-            # get tab entry
-            tab_entry = readfis(f + i * 8)
-
-            # if entry is paged
-            if tab_entry & 1:
-
-                # get next table / frame address (zero all access bits)
-                f1 = tab_entry & ~0xFFF
-
-                # Get string info on all flags
-                fl = []
-                for j in flags:
-                    fl.append(flags[j] if tab_entry & (1 << j) else nflags[j])
-
-                # write tab entry index in octal representation
-                tab_entry_index_octal = ("{:03o}".format(i))
-
-                # construct a string with all access info
-                tab_entry_access_bits = "".join(fl)
-
-                # tab address
-                tab_address = vm_paddr_to_str(f1)
-                
-                # append entry and info
-                tab = {}
-                tab_entry_data = {}
-                # o - octal
-                tab_entry_data['o'] = tab_entry_index_octal
-                # x - access
-                tab_entry_data['x'] = tab_entry_access_bits
-                # a - address
-                tab_entry_data['a'] = tab_address
-                # i - info
-                tab['i'] = tab_entry_data
-                # s - sub list
-                tab['s'] = []
-                
-                # if not frame descriptor at > max_liv, show path for entire tab and append it to the entry
-                if not tab_entry & (1<<7):
-                    sub_list = []
-                    vm_decode(f1, liv - 1, sub_list, stop - 1, rngs)
+        # otherwise (entry is frame address)
+        elif maps:
+            vm_map_entry(lin | (i << (12 + 9 * (liv - 1))), a)
 
-                    if sub_list:
-                        tab['s'].append(sub_list)
-                
-                vm_list.append(tab)
+        # empty the virt array (recursive call, only empty current element)
+        virt.pop()
 
-def VmMaps():
+    # the subtree can be visited again only if nothing in it was skipped as already visited
+    if liv < max_liv and vm_skips == start[4]:
+        seen_tables = vm_seen_tables[start[5]:]
+        # and then its nodes only depend on the bytes of its tables
+        if tree and liv > 1 and len(vm_list) > start[0]:
+            vm_list[start[0]:] = [ vm_subtree_fragment(liv, cur, seen_tables, vm_list[start[0]:]) ]
+        seen_tree = vm_seen_tree[start[3]:]
+        tables = { t: vm_tables[t] for t in seen_tables }
+        vm_memo[key] = (vm_list[start[0]:], vm_events[start[1]:], tables, vm_seen_maps[start[2]:], seen_tree)
+
+def vm_space(pid=None):
+    """(cr3, privilege level) of the address space of process pid, or of the current one"""
+    if pid is None:
+        return (toi(gdb.parse_and_eval('$cr3')), toi(gdb.parse_and_eval('$cs')) & 0x3)
+    addr = readfis(proc_table_addr + 8 * pid) if 0 <= pid < max_proc else 0
+    if not addr:
+        raise gdb.GdbError("no such process")
+    return (des_proc_layout.read_field(addr, 'cr3'), des_proc_layout.read_field(addr, 'livello'))
+
+def vm_shared():
     """
-    Show the mappings of an address space.
-
-    The output is formatted as a JSON array, structured as:
-    [
-        {
-            "part": <memory part 1 name>
-            "info": {
-                [
-                    "a": <virtual space address (initial address)>
-                    "x": <access control bits>
-                    "o": <octal address mapping>
-                    "t": <access type (r / w)>
-                ],
-                [
-                    "a": <virtual space address (initial address)>
-                    "x": <access control bits>
-                    "o": <octal address mapping>
-                    "t": <access type (r / w)>
-                ]
-            }
-        },
-        ...,
-    ]
+    The tables referenced by the root tables of more than one process,
+    computed once per memory generation
+    """
+    global vm_shared_tables, vm_shared_generation
+
+    if vm_shared_generation != mem_generation:
+        roots = set(des_proc_layout.read_field(addr, 'cr3') for _, addr in process_table())
+        seen = set()
+        vm_shared_tables = set()
+        for cr3 in roots:
+            for e in readtab(cr3):
+                if vm_is_table[e & 0xfff]:
+                    f = e & ~0xfff
+                    if f in seen:
+                        vm_shared_tables.add(f)
+                    seen.add(f)
+        vm_shared_generation = mem_generation
+    return vm_shared_tables
+
+def VmShared(cr3):
+    """indexes of the root tab entries of cr3 whose subtrees are shared with other processes"""
+    shared = vm_shared()
+    return [ i for i, e in enumerate(readtab(cr3)) if vm_is_table[e & 0xfff] and e & ~0xfff in shared ]
+
+def VmWalk(maps=True, tree=True, space=None):
+    """
+    Walk the translation tree of an address space once, returning its
+    vm maps (see VmMaps) and its vm tree (see VmTree). Either part can be
+    skipped. space is the (cr3, privilege level) of the address space
+    (see vm_space), the current one by default.
     """
-    global vm_last, cs_cur, wp_cur, m_ini, current_part, MEM_MAPS, past_tables
+    global vm_last, vm_run, vm_flags_ids, cs_cur, wp_cur, m_ini, current_part, MEM_MAPS, MEM_TREE
 
     # get context
-    cs_cur = toi(gdb.parse_and_eval('$cs')) & 0x3
+    if space is None:
+        space = vm_space()
+    cr3, cs_cur = space
     wp_cur = toi(gdb.parse_and_eval('$cr0')) & (1 << 16)
 
     # initialize global variables
     vm_last = 0xffff
+    vm_run = None
+    vm_flags_ids = {}
     current_part = 0
     MEM_MAPS = [None] * (len(m_ini) - 1) # len - 1 to account for mio_p not present
-    past_tables = set()
+    MEM_TREE = []
+    vm_walk_reset()
 
-    # recursive call
-    cr3 = toi(gdb.parse_and_eval('$cr3'))
-    vm_show_maps_rec(cr3, max_liv, [], 0x7)
-    
-    return MEM_MAPS
+    # single recursive visit for both outputs
+    vm_walk(cr3, max_liv, [], 0x7, MEM_TREE, maps, tree)
+    if maps:
+        # the last run reaches the end of the address space
+        vm_run_close(1 << (12 + 9 * max_liv))
+
+    vm_maps = {}
+    vm_maps['flags'] = [ { 'x': x, 't': t } for (x, t), _ in sorted(vm_flags_ids.items(), key=lambda f: f[1]) ]
+    vm_maps['parts'] = MEM_MAPS
 
-def VmTree():
+    out = {}
+    out['depth_level'] = max_liv
+    out['vm_tree'] = MEM_TREE
+    return (vm_maps if maps else None, out if tree else None)
+
+def VmMaps():
     """
-    Show the translation tree of a virtual address space
+    Show the mappings of an address space, as runs of consecutive
+    addresses with the same access bits.
+
+    The output is formatted as a JSON object, structured as:
+    {
+        "flags": [
+            {
+                "x": <access control bits>
+                "t": <access type (r / w)>
+            },
+            ...
+        ],
+        "parts": [
+            {
+                "part": <memory part 1 name>
+                "runs": [
+                    [ <first address>, <last address>, <number of pages>, <index in flags> ],
+                    ...
+                ]
+            },
+            ...,
+        ]
+    }
+    """
+    return VmWalk(tree=False)[0]
+
+def vm_tree_nodes(tab, liv, depth, first=0, last=tab_entries - 1):
+    '''
+    Builds the vm_tree nodes of the present entries first..last of a table, decoding
+    the tables below only down to depth levels (1: only this table). The nodes of
+    the entries pointing to a table that is not decoded are marked with "l": 1
+        tab:        table address
+        liv:        table level
+        depth:      number of levels to decode
+        first:      first tab entry index
+        last:       last tab entry index
+    '''
+    if liv == 1 and first == 0 and last == tab_entries - 1:
+        f = vm_leaf_fragment(*readtab_hashed(tab))[0]
+        return [ f ] if f is not None else []
+
+    entries = readtab(tab)
+    present = list(compress(range(first, last + 1), map(and_, entries[first:last + 1], repeat(1))))
+    nodes = list(map(vm_tree_entry, present, map(entries.__getitem__, present)))
+    if liv > 1:
+        for i, node in zip(present, nodes):
+            if not vm_is_table[entries[i] & 0xfff]:
+                continue
+            if depth > 1:
+                sub_list = vm_tree_nodes(entries[i] & ~0xfff, liv - 1, depth - 1)
+                if sub_list:
+                    node['s'].append(sub_list)
+            else:
+                node['l'] = 1
+    return nodes
+
+def VmTree(depth=None, first=0, last=tab_entries - 1, cr3=None):
+    """
+    Show the translation tree of a virtual address space (the current one by
+    default). Only the root entries first..last are shown, and only depth
+    levels are decoded: the nodes of the tables left out are marked with
+    "l": 1, and can be shown later with VmSubtree.
 
     The output is formatted as a JSON object, structured as:
     {
@@ -727,33 +1825,1188 @@ def VmTree():
                 "s": [
                     {{same estructure as parent node}}
                 ]
+                "l": 1 (only if the table below has not been decoded)
             },
             ...,
         ]
     }
     """
-    global MEM_TREE, past_tables
-    MEM_TREE = []
-    past_tables = set()
+    if depth is None and first == 0 and last == tab_entries - 1 and cr3 is None:
+        return VmWalk(maps=False)[1]
+
+    if cr3 is None:
+        cr3 = vm_space()[0]
     out = {}
     out['depth_level'] = max_liv
-    f = toi(gdb.parse_and_eval('$cr3'))
-    vm_decode(f, max_liv, MEM_TREE)
-    out['vm_tree'] = MEM_TREE
+    out['vm_tree'] = vm_tree_nodes(cr3, max_liv, max_liv if depth is None else depth, first, last)
     return out
 
+def parse_tree_options(options):
+    """(depth, first, last) of the '--depth <n>' and '--range <a>-<b>' options of a tree"""
+    try:
+        depth = int(options['depth']) if 'depth' in options else None
+        first, last = 0, tab_entries - 1
+        if 'range' in options:
+            first, _, last = options['range'].partition('-')
+            first = int(first, 0)
+            last = int(last, 0) if last else first
+    except ValueError:
+        raise gdb.GdbError("invalid --depth or --range")
+    if (depth is not None and depth < 1) or not 0 <= first <= last < tab_entries:
+        raise gdb.GdbError("invalid --depth or --range")
+    return (depth, first, last)
+
+# the trees of the last few address spaces a delta was asked for, by cr3
+vm_snapshots_max = 4
+
+def vm_snapshot_put(cr3):
+    """keep the tables of the tree just walked, with their bytes, to answer later delta requests"""
+    tables = { t: (digest, tab_struct.pack(*entries)) for t, (digest, entries) in vm_tables.items() }
+    vm_snapshots[cr3] = { 'generation': mem_generation, 'tables': tables }
+    vm_snapshots.move_to_end(cr3)
+    while len(vm_snapshots) > vm_snapshots_max:
+        vm_snapshots.popitem(last=False)
+
+def vm_delta_rec(tab, liv, path, old_tables, delta):
+    '''
+    Compares a table with its previous snapshot, appending the differences to delta
+        tab:        table address
+        liv:        table level
+        path:       array of tab entries indexes leading to this table
+        old_tables: tables of the previous snapshot (address -> (hash, bytes))
+        delta:      dictionary of "added", "removed" and "changed" lists
+    '''
+    # check that memory tree is not recursive
+    if tab in tree_tables:
+        return
+    tree_tables.add(tab)
+
+    vm_tables[tab] = readtab_hashed(tab)
+    digest, entries = vm_tables[tab]
+
+    # if the bytes are the same only the subtables may have changed
+    old = old_tables.get(tab)
+    old_entries = None
+    if old is None:
+        old_entries = (0,) * tab_entries
+    elif old[0] != digest:
+        old_entries = tab_struct.unpack(old[1])
+
+    for i in range(tab_entries):
+        e = entries[i]
+        is_table = liv > 1 and not e & (1 << 7)
+
+        if old_entries is not None and old_entries[i] != e:
+            o = old_entries[i]
+
+            if not e & 1:
+                if o & 1:
+                    delta['removed'].append(path + [i])
+                continue
+
+            node = vm_tree_entry(i, e)
+            same_table = is_table and o & 1 and not o & (1 << 7) and (o & ~0xfff) == (e & ~0xfff)
+
+            # a new (or different) table: send its whole subtree
+            if not same_table:
+                if is_table:
+                    sub_list = []
+                    vm_walk(e & ~0xfff, liv - 1, path + [i], 0x7, sub_list, maps=False)
+                    if sub_list:
+                        node['s'].append(sub_list)
+                elif liv == 1 and not e & (1 << 7):
+                    tree_tables.add(e & ~0xfff)
+                if o & 1:
+                    delta['changed'].append({ 'p': path + [i], 'i': node['i'], 's': node['s'] })
+                else:
+                    delta['added'].append({ 'p': path + [i], 'n': node })
+                continue
+
+            # only the access bits changed: the subtree is compared below
+            delta['changed'].append({ 'p': path + [i], 'i': node['i'] })
+
+        if e & 1 and is_table:
+            vm_delta_rec(e & ~0xfff, liv - 1, path + [i], old_tables, delta)
+        elif e & 1 and liv == 1 and not e & (1 << 7):
+            tree_tables.add(e & ~0xfff)
+
+def VmTreeDelta(generation, cr3=None):
+    """
+    Compare the translation tree of an address space (the current one by
+    default) with the one sent at the given generation, re-decoding only the
+    tables whose bytes changed. Returns None if that snapshot is not available
+    anymore.
+
+    The output is formatted as a JSON object, structured as:
+    {
+        "added": [
+            {
+                "p": [ <root tab entry index>, ..., <tab entry index> ]
+                "n": {{vm_tree node, same structure as in VmTree}}
+            },
+            ...
+        ],
+        "removed": [
+            [ <root tab entry index>, ..., <tab entry index> ],
+            ...
+        ],
+        "changed": [
+            {
+                "p": [ <root tab entry index>, ..., <tab entry index> ]
+                "i": {{new node info}}
+                "s": {{new sub list, only if the whole subtree changed}}
+            },
+            ...
+        ]
+    }
+    """
+    if cr3 is None:
+        cr3 = vm_space()[0]
+    snapshot = vm_snapshots.get(cr3)
+    if snapshot is None or snapshot['generation'] != generation:
+        return None
+    vm_snapshots.move_to_end(cr3)
+
+    delta = { 'added': [], 'removed': [], 'changed': [] }
+
+    # the snapshot is still current: nothing can have changed
+    if generation == mem_generation:
+        return delta
+
+    vm_walk_reset()
+    vm_delta_rec(cr3, max_liv, [], snapshot['tables'], delta)
+    vm_snapshot_put(cr3)
+    return delta
+
 
 class MemoryAll(gdb.Command):
+    """Dump the vm maps and the vm tree of an address space as JSON.
+Usage: MemoryAll [<pid> | all] [--delta <generation>] [--shared] [--file]
+The address space is the current one, the one of process <pid> (any expression
+returning a process id) or, with 'all', the ones of all the live processes, in
+'processes'; the access types of a process are the ones of its level.
+With '--shared', 'shared' lists the root tab entries whose subtrees are shared
+with other processes: they are decoded only once, whatever the processes shown.
+Finding them reads the root tab of every live process.
+With '--delta <generation>', the tree is replaced by the differences with
+respect to the tree sent at that generation, when still available: only the
+trees sent to the last few '--delta' requests are kept.
+With '--depth <n>', only the top n levels of the tree are decoded (see VmTree).
+With '--file', the JSON is written to a temporary file and only a handle to
+it is printed."""
+
+    name = "MemoryAll"
+    flags = ('file', 'shared')
+    values = ('delta', 'depth')
+    usage = "usage: MemoryAll [<pid> | all] [--delta <generation>] [--depth <n>] [--shared] [--file]"
 
     def __init__(self):
-        super(MemoryAll, self).__init__("MemoryAll", gdb.COMMAND_DATA)
+        super(MemoryAll, self).__init__(self.name, gdb.COMMAND_DATA)
 
     def invoke(self, arg, from_tty):
+        options, args = parse_options(arg, self.flags, self.values)
+        if len(args) > 1 or (args == ['all'] and 'delta' in options):
+            raise gdb.GdbError(self.usage)
+        self.base(options)
+        if args:
+            options['pid'] = args[0] if args[0] == 'all' else str(int(gdb.parse_and_eval(args[0])))
+        write_output(self.name, cached_output(self, options), options)
+
+    def space(self, options):
+        """the address space selected by options"""
+        return vm_space(int(options['pid']) if 'pid' in options else None)
+
+    def base(self, options):
+        """generation of the '--delta <generation>' option, or None"""
+        if 'delta' not in options:
+            return None
+        try:
+            generation = int(options['delta'])
+        except ValueError:
+            raise gdb.GdbError(self.usage)
+        if generation < 0:
+            raise gdb.GdbError(self.usage)
+        return generation
+
+    def address_space(self, space, generation=None, depth=None, shared=False):
+        """maps and tree (or delta since generation, or only depth levels) of an address space"""
         out = {}
-        out['maps'] = VmMaps()
-        out['tree'] = VmTree()
+        delta = None
+        if generation is not None and depth is None:
+            delta = VmTreeDelta(generation, space[0])
+
+        if depth is not None:
+            out['maps'] = VmWalk(tree=False, space=space)[0]
+            out['tree'] = VmTree(depth, cr3=space[0])
+        elif delta is None:
+            out['maps'], out['tree'] = VmWalk(space=space)
+            # the next delta can start from this tree
+            if generation is not None:
+                vm_snapshot_put(space[0])
+        else:
+            out['maps'] = VmWalk(tree=False, space=space)[0]
+            out['delta'] = delta
+            out['base'] = generation
+        if shared:
+            out['shared'] = VmShared(space[0])
+        return out
+
+    def compute(self, options):
+        depth = parse_tree_options(options)[0]
+        shared = 'shared' in options
+        if options.get('pid') == 'all':
+            out = {}
+            out['processes'] = []
+            for pid, addr in process_table():
+                space = (des_proc_layout.read_field(addr, 'cr3'), des_proc_layout.read_field(addr, 'livello'))
+                out['processes'].append(dict(self.address_space(space, depth=depth, shared=shared), pid=pid))
+        else:
+            generation = self.base(options)
+            out = self.address_space(self.space(options), generation, depth, shared)
+            if 'pid' in options:
+                out['pid'] = int(options['pid'])
+        out['generation'] = mem_generation
+        return out
+
+    def next_options(self, options):
+        """after a stop, the client asks for the changes since the tree it has"""
+        if options.get('pid') == 'all' or 'depth' in options:
+            return options
+        snapshot = vm_snapshots.get(self.space(options)[0])
+        if snapshot is None:
+            return options
+        return dict(options, delta=str(snapshot['generation']))
+
+memory_all = MemoryAll()
+
+class VmTreeCommand(gdb.Command):
+    """Dump the translation tree of an address space as JSON.
+Usage: VmTree [<pid>] [--depth <n>] [--range <a>-<b>] [--file]
+The address space is the current one or the one of process <pid>. Only the
+root tab entries a..b are shown (e.g. '--range 0o400-0o777'), and only the top
+n levels are decoded: the tables below are marked with "l": 1 and can be
+decoded later with VmSubtree.
+With '--file', the JSON is written to a temporary file and only a handle to
+it is printed."""
+
+    name = "VmTree"
+    flags = ('file',)
+    values = ('depth', 'range')
+
+    def __init__(self):
+        super(VmTreeCommand, self).__init__(self.name, gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        options, args = parse_options(arg, self.flags, self.values)
+        if len(args) > 1:
+            raise gdb.GdbError("usage: VmTree [<pid>] [--depth <n>] [--range <a>-<b>] [--file]")
+        if args:
+            options['pid'] = str(int(gdb.parse_and_eval(args[0])))
+        parse_tree_options(options)
+        write_output(self.name, cached_output(self, options), options)
+
+    def compute(self, options):
+        depth, first, last = parse_tree_options(options)
+        return VmTree(depth, first, last, memory_all.space(options)[0])
+
+VmTreeCommand()
+
+class VmSubtree(gdb.Command):
+    """Dump the translation tree below a table as JSON.
+Usage: VmSubtree <table-paddr> <level> [--depth <n>] [--file]
+The output has the same structure as the one of VmTree, for the table at
+physical address <table-paddr> seen as a level <level> table, decoding only the
+top n levels (default: 1, the table itself).
+With '--file', the JSON is written to a temporary file and only a handle to
+it is printed."""
+
+    name = "VmSubtree"
+    flags = ('file',)
+    values = ('depth',)
+
+    def __init__(self):
+        super(VmSubtree, self).__init__(self.name, gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        options, args = parse_options(arg, self.flags, self.values)
+        if len(args) != 2:
+            raise gdb.GdbError("usage: VmSubtree <table-paddr> <level> [--depth <n>] [--file]")
+        options['table'] = str(toi(gdb.parse_and_eval(args[0])) & ~0xfff)
+        options['level'] = str(int(gdb.parse_and_eval(args[1])))
+        if not 1 <= int(options['level']) <= max_liv:
+            raise gdb.GdbError("the level must be between 1 and {}".format(max_liv))
+        parse_tree_options(options)
+        # the subtrees are asked for when they are shown, not at every stop
+        write_output(self.name, cached_output(self, options, remember=False), options)
+
+    def compute(self, options):
+        depth = parse_tree_options(options)[0]
+        out = {}
+        out['level'] = int(options['level'])
+        out['vm_tree'] = vm_tree_nodes(int(options['table']), out['level'], depth or 1)
+        return out
+
+VmSubtree()
+
+class Translate(gdb.Command):
+    """Translate virtual addresses in the address space rooted at <cr3>.
+Usage: Translate <cr3> <vaddr>...
+Both can be expressions (e.g. '$cr3' or 'proc_table[3]->cr3'). The output is a JSON array
+with, for each address:
+    {
+        "vaddr": <virtual address>,
+        "paddr": <physical address, or null if not mapped>,
+        "entries": [ <tab entry of each level met, from the root down> ],
+        "rights": <effective rights of the whole path ("S"/"U", "R"/"W", "NX")>
+    }"""
+
+    def __init__(self):
+        super(Translate, self).__init__("Translate", gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) < 2:
+            raise gdb.GdbError("usage: Translate <cr3> <vaddr>...")
+
+        def value(a):
+            # plain numbers do not need gdb
+            try:
+                return int(a, 0)
+            except ValueError:
+                return toi(gdb.parse_and_eval(a))
+
+        cr3 = value(argv[0])
+        out = []
+        for a in argv[1:]:
+            vaddr = value(a)
+            paddr, mask, entries, rights, nx = tlb_translate(cr3, vaddr)
+            t = {}
+            t['vaddr'] = "{:#x}".format(vaddr)
+            t['paddr'] = None if paddr is None else "{:#x}".format(paddr | (vaddr & mask))
+            t['entries'] = [ "{:#x}".format(e) for e in entries ]
+            if paddr is None:
+                t['rights'] = ""
+            else:
+                t['rights'] = " ".join([ "U" if rights & 4 else "S", "W" if rights & 2 else "R" ] + ([ "NX" ] if nx else []))
+            out.append(t)
         gdb.write(json.dumps(out) + "\n")
 
-MemoryAll()
+Translate()
+
+def rmap_build():
+    """
+    Build the reverse map of the translation trees of all the live processes,
+    reading every distinct table once, however many processes share it:
+        'roots':   cr3 -> pids using it
+        'parents': (table, level) -> [ (parent table, parent level, index, entry) ]
+        'frames':  frame address -> [ (table, level, index, entry) ], the entries
+                   pointing to the frame (as a page or as a table)
+        'large':   (level, page address) -> [ (table, level, index, entry) ], the large pages
+    """
+    roots = {}
+    for pid, addr in process_table():
+        roots.setdefault(des_proc_layout.read_field(addr, 'cr3'), []).append(pid)
+
+    parents = {}
+    frames = {}
+    large = {}
+    visited = set()
+    todo = [ (cr3, max_liv) for cr3 in roots ]
+    while todo:
+        tab, liv = todo.pop()
+        if (tab, liv) in visited:
+            continue
+        visited.add((tab, liv))
+
+        entries = readtab(tab)
+        for i in compress(range(tab_entries), map(and_, entries, repeat(1))):
+            e = entries[i]
+            f = e & paddr_mask
+            ref = (tab, liv, i, e)
+            if liv > 1 and e & (1 << 7):
+                large.setdefault((liv, f & ~((1 << (12 + 9 * (liv - 1))) - 1)), []).append(ref)
+                continue
+            frames.setdefault(f, []).append(ref)
+            if liv > 1:
+                parents.setdefault((f, liv - 1), []).append(ref)
+                todo.append((f, liv - 1))
+
+    return { 'roots': roots, 'parents': parents, 'frames': frames, 'large': large }
+
+def rmap_get():
+    """the reverse map (see rmap_build), built once per memory generation"""
+    global rmap, rmap_generation
+
+    if rmap_generation != mem_generation:
+        rmap = rmap_build()
+        rmap_generation = mem_generation
+    return rmap
+
+def rmap_paths(rm, tab, liv, paths):
+    """
+    (pid, linear address, access bits of the path) of every way table tab of level liv
+    is reached from the root of a process, memoised in paths
+    """
+    key = (tab, liv)
+    if key not in paths:
+        out = []
+        if liv == max_liv:
+            out += [ (pid, 0, 0x7) for pid in rm['roots'].get(tab, []) ]
+        else:
+            for ptab, pliv, i, e in rm['parents'].get(key, []):
+                for pid, lin, cur in rmap_paths(rm, ptab, pliv, paths):
+                    out.append((pid, lin | (i << (12 + 9 * (pliv - 1))), cur & e))
+        paths[key] = out
+    return paths[key]
+
+def WhoMaps(paddr):
+    """
+    The virtual addresses that map physical address paddr, in all the live processes,
+    as a list of { "pid", "vaddr", "level", "kind", "x" } objects, where level is the level
+    of the entry, kind is "page", "table" (the frame is used as a table) or "root" (the frame
+    is the root table of the process) and x are the effective access bits of the mapping
+    """
+    rm = rmap_get()
+    out = [ { 'pid': pid, 'vaddr': None, 'level': max_liv, 'kind': "root", 'x': "" }
+            for pid in rm['roots'].get(paddr & paddr_mask, []) ]
+    refs = [ (r, 0xfff) for r in rm['frames'].get(paddr & paddr_mask, []) ]
+    for liv in range(2, max_liv + 1):
+        mask = (1 << (12 + 9 * (liv - 1))) - 1
+        refs += [ (r, mask) for r in rm['large'].get((liv, paddr & ~mask & paddr_mask), []) ]
+
+    paths = {}
+    for (tab, liv, i, e), mask in refs:
+        kind = "table" if liv > 1 and not e & (1 << 7) else "page"
+        for pid, lin, cur in rmap_paths(rm, tab, liv, paths):
+            lin |= i << (12 + 9 * (liv - 1))
+            m = {}
+            m['pid'] = pid
+            m['vaddr'] = vm_addr_to_str(lin | (paddr & mask) if kind == "page" else lin)
+            m['level'] = liv
+            m['kind'] = kind
+            m['x'] = vm_access_str[vm_effective[liv > 1, cur & 6][e & 0xfff]]
+            out.append(m)
+    out.sort(key=lambda m: (m['pid'], m['vaddr'] or ""))
+    return out
+
+class WhoMapsCommand(gdb.Command):
+    """Show which virtual addresses, in which processes, map a physical address, as JSON.
+Usage: WhoMaps <paddr>
+<paddr> can be any expression. The output is structured as:
+    {
+        "paddr": <physical address>,
+        "mappings": [
+            {
+                "pid": <process id>,
+                "vaddr": <virtual address (null for a root table)>,
+                "level": <level of the tab entry>,
+                "kind": <"page", "table" if the frame is used as a table, "root" if it is a root table>,
+                "x": <effective access bits>
+            },
+            ...
+        ],
+        "generation": <memory generation>
+    }
+The reverse map of all the translation trees is built once per stop, reading
+every table once even if it is shared by several processes."""
+
+    name = "WhoMaps"
+    flags = ('file',)
+    values = ()
+
+    def __init__(self):
+        super(WhoMapsCommand, self).__init__(self.name, gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+
+    def invoke(self, arg, from_tty):
+        options, args = parse_options(arg, self.flags, self.values)
+        if len(args) != 1:
+            raise gdb.GdbError("usage: WhoMaps <paddr> [--file]")
+        options['paddr'] = str(toi(gdb.parse_and_eval(args[0])))
+        # the queries are not computed again at every stop, only the reverse map is
+        write_output(self.name, cached_output(self, options, remember=False), options)
+
+    def compute(self, options):
+        paddr = int(options['paddr'])
+        out = {}
+        out['paddr'] = "{:#x}".format(paddr)
+        out['mappings'] = WhoMaps(paddr)
+        out['generation'] = mem_generation
+        return out
+
+WhoMapsCommand()
+
+# The translation trees of the last vm_history_size memory generations, to compare
+# them with VmDiff. Every generation maps each (table, level) reachable from a cr3 to
+# (digest of the subtree, digest of the table), where the digest of a subtree covers
+# the bytes of the table and the digests of the subtrees below it: two subtrees with
+# the same digest are the same, whatever their address or generation. The content of
+# the tables is kept once per digest in vm_history_raw.
+
+class NucleoVmHistory(gdb.Parameter):
+    """Number of memory generations whose translation trees are remembered by VmDiff.
+Every table reachable from a cr3 is read at each stop, so it is 0 by default: only
+the current generation is then recorded, when VmDiff asks for it."""
+
+    set_doc = "Set the number of translation trees remembered by VmDiff."
+    show_doc = "Show the number of translation trees remembered by VmDiff."
+
+    def __init__(self):
+        super(NucleoVmHistory, self).__init__("nucleo-vm-history", gdb.COMMAND_DATA, gdb.PARAM_ZUINTEGER)
+        self.value = 0
+        self.get_set_string()
+
+    def get_set_string(self):
+        vm_history.clear()
+        vm_history_raw.clear()
+        return ""
+
+    def get_show_string(self, svalue):
+        return "VmDiff remembers the translation trees of {} generations.".format(svalue)
+
+vm_history_size = NucleoVmHistory()
+
+def vm_history_table(tab, liv, tables):
+    """the digest of the subtree of table tab of level liv, adding it and the tables below to tables"""
+    key = (tab, liv)
+    t = tables.get(key)
+    if t is None:
+        try:
+            raw = readmem(tab, tab_struct.size)
+        except gdb.MemoryError:
+            # outside of the physical memory: seen as an empty table
+            tables[key] = t = (hashlib.blake2b(b'unreadable', digest_size=16).digest(), None)
+            return t[0]
+        digest = hashlib.blake2b(raw, digest_size=16).digest()
+        vm_history_raw.setdefault(digest, raw)
+        if liv > 1:
+            entries = tab_struct.unpack(raw)
+            h = hashlib.blake2b(digest, digest_size=16)
+            # the tables are sparse: look only at the entries that are not zero
+            for e in filter(None, entries):
+                if vm_is_table[e & 0xfff]:
+                    h.update(vm_history_table(e & paddr_mask, liv - 1, tables))
+            tables[key] = t = (h.digest(), digest)
+        else:
+            tables[key] = t = (digest, digest)
+    return t[0]
+
+def vm_history_record():
+    """record the translation trees of the current generation: of every live process and of $cr3"""
+    tables = {}
+    entry = {}
+    entry['cr3'] = toi(gdb.parse_and_eval('$cr3')) & paddr_mask
+    entry['roots'] = { pid: des_proc_layout.read_field(addr, 'cr3') & paddr_mask for pid, addr in process_table() }
+    entry['tables'] = tables
+    for cr3 in set(entry['roots'].values()) | { entry['cr3'] }:
+        vm_history_table(cr3, max_liv, tables)
+
+    vm_history[mem_generation] = entry
+    if len(vm_history) > max(vm_history_size.value, 1):
+        while len(vm_history) > max(vm_history_size.value, 1):
+            vm_history.popitem(last=False)
+        # forget the content of the tables no generation refers to anymore
+        live = set(d for h in vm_history.values() for _, d in h['tables'].values())
+        for d in [ d for d in vm_history_raw if d not in live ]:
+            del vm_history_raw[d]
+    return entry
+
+def vm_history_get(generation):
+    """the translation trees of a generation (see vm_history_record), or None if forgotten"""
+    if generation not in vm_history and generation == mem_generation:
+        return vm_history_record()
+    return vm_history.get(generation)
+
+def vm_history_stop(event):
+    """record the translation trees at every stop"""
+    if not vm_history_size.value:
+        return
+    try:
+        vm_history_record()
+    except (gdb.MemoryError, gdb.error):
+        # e.g. before the nucleo has initialized its structures
+        return
+
+# after the page cache has been invalidated by the same event
+gdb.events.stop.connect(vm_history_stop)
 
-#endregion
\ No newline at end of file
+def vm_diff_entry(e, liv):
+    """the old or new side of a difference: None if e is not present"""
+    if not e & 1:
+        return None
+    return (vm_tree_flags[e & 0xfff], e & ~0xfff, liv > 1 and vm_is_table[e & 0xfff])
+
+def vm_diff_add(diffs, start, liv, old, new):
+    """append a difference, merging it with the last one if they continue each other"""
+    span = 1 << (12 + 9 * (liv - 1))
+    if diffs:
+        last = diffs[-1]
+        lstart, lliv, n, lold, lnew = last
+        if lliv == liv and lstart + n * span == start and all(
+                (a is None and b is None) or (a is not None and b is not None and not a[2] and not b[2] and
+                                              a[0] == b[0] and a[1] + n * span == b[1])
+                for a, b in ((lold, old), (lnew, new))):
+            last[2] += 1
+            return
+    diffs.append([ start, liv, 1, old, new ])
+
+def vm_diff_rec(a, b, ta, tb, liv, lin, diffs, stats):
+    '''
+    Compares two tables of level liv, appending the differences of their subtrees to diffs
+        a, b:       generations of the two sides (see vm_history_record)
+        ta, tb:     addresses of the tables
+        lin:        linear address of the first entry
+        diffs:      list of differences, see vm_diff_add
+        stats:      counters of the tables compared
+    '''
+    da, ra = a['tables'][(ta, liv)]
+    db, rb = b['tables'][(tb, liv)]
+    # same subtree (in particular, the same table in the same generation)
+    if da == db:
+        return
+    stats['tables'] += 1
+    ea = tab_struct.unpack(vm_history_raw[ra]) if ra is not None else (0,) * tab_entries
+    eb = tab_struct.unpack(vm_history_raw[rb]) if rb is not None else (0,) * tab_entries
+
+    shift = 12 + 9 * (liv - 1)
+    for i in range(tab_entries):
+        x, y = ea[i], eb[i]
+        sub = liv > 1 and vm_is_table[x & 0xfff] and vm_is_table[y & 0xfff]
+        if x == y and not sub:
+            continue
+        start = lin | (i << shift)
+        if sub:
+            # both are tables: only their own bits, and what is below them, can differ
+            if x & 0xfff != y & 0xfff:
+                vm_diff_add(diffs, start, liv, vm_diff_entry(x, liv), vm_diff_entry(y, liv))
+            vm_diff_rec(a, b, x & paddr_mask, y & paddr_mask, liv - 1, start, diffs, stats)
+        else:
+            vm_diff_add(diffs, start, liv, vm_diff_entry(x, liv), vm_diff_entry(y, liv))
+
+def VmDiff(a, b):
+    """
+    Compare the translation trees of two address spaces, a and b, each given as
+    (generation, pid), pid being None for the one of $cr3. Only the tables whose
+    subtrees differ are decoded. Returns the list of the divergent ranges:
+    [
+        {
+            "start": <first virtual address>, "end": <last virtual address>,
+            "level": <level of the tab entries>, "n": <number of tab entries>,
+            "old": { "x": <access bits>, "a": <first frame>, "t": 1 (only if "a" is a table) } or null,
+            "new": {{same structure as old}}
+        },
+        ...
+    ]
+    and the number of pairs of tables compared
+    """
+    # the current generation first, as recording it may forget the oldest one
+    history = {}
+    for generation in sorted({ a[0], b[0] }, key=lambda g: g != mem_generation):
+        history[generation] = vm_history_get(generation)
+
+    sides = []
+    for generation, pid in (a, b):
+        h = history[generation]
+        if h is None:
+            raise gdb.GdbError("generation {} is not remembered (see 'set nucleo-vm-history')".format(generation))
+        if pid is None:
+            root = h['cr3']
+        elif pid in h['roots']:
+            root = h['roots'][pid]
+        else:
+            raise gdb.GdbError("no process {} at generation {}".format(pid, generation))
+        sides.append((h, root))
+
+    diffs = []
+    stats = { 'tables': 0 }
+    vm_diff_rec(sides[0][0], sides[1][0], sides[0][1], sides[1][1], max_liv, 0, diffs, stats)
+
+    def side(d):
+        if d is None:
+            return None
+        out = { 'x': d[0], 'a': "0x{:08x}".format(d[1]) }
+        if d[2]:
+            out['t'] = 1
+        return out
+
+    out = []
+    for start, liv, n, old, new in diffs:
+        d = {}
+        d['start'] = vm_addr_to_str(start)
+        d['end'] = vm_addr_to_str(start + (n << (12 + 9 * (liv - 1))) - 1)
+        d['level'] = liv
+        d['n'] = n
+        d['old'] = side(old)
+        d['new'] = side(new)
+        out.append(d)
+    return (out, stats['tables'])
+
+class VmDiffCommand(gdb.Command):
+    """Compare the translation trees of two address spaces, as JSON.
+Usage: VmDiff <pid|g<generation>> <pid|g<generation>> [--file]
+A side is either a process (any expression returning a process id), as it is now,
+or 'g' followed by a memory generation: the same address space as the other side,
+as it was at that generation ($cr3 if both sides are generations). The trees of
+the last generations are remembered only with 'set nucleo-vm-history <n>'.
+The output is structured as:
+    {
+        "a": { "pid": <process id or null>, "generation": <memory generation> },
+        "b": {{same structure as a}},
+        "diffs": [
+            {
+                "start": <first virtual address>, "end": <last virtual address>,
+                "level": <level of the tab entries>, "n": <number of tab entries>,
+                "old": { "x": <access bits>, "a": <first frame>, "t": 1 (only if "a" is a table) } or null,
+                "new": {{same structure as old}}
+            },
+            ...
+        ],
+        "tables": <number of pairs of tables compared>,
+        "generation": <memory generation>
+    }
+Consecutive entries whose frames and access bits continue each other are merged.
+The subtrees with the same content on both sides are skipped after comparing
+their digests, so the cost depends on the tables that differ."""
+
+    name = "VmDiff"
+    flags = ('file',)
+    values = ()
+
+    def __init__(self):
+        super(VmDiffCommand, self).__init__(self.name, gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+
+    def invoke(self, arg, from_tty):
+        options, args = parse_options(arg, self.flags, self.values)
+        if len(args) != 2:
+            raise gdb.GdbError("usage: VmDiff <pid|g<generation>> <pid|g<generation>> [--file]")
+        for name, a in zip(('a', 'b'), args):
+            if re.match(r'^g\d+$', a):
+                options[name] = a
+            else:
+                options[name] = str(int(gdb.parse_and_eval(a)))
+        # the comparisons are asked for by the user, not recomputed at every stop
+        write_output(self.name, cached_output(self, options, remember=False), options)
+
+    def compute(self, options):
+        sides = []
+        for name in ('a', 'b'):
+            a = options[name]
+            if a.startswith('g'):
+                sides.append((int(a[1:]), None))
+            else:
+                sides.append((mem_generation, int(a)))
+        # a generation compares the address space of the other side
+        (ga, pa), (gb, pb) = sides
+        if pa is None:
+            pa = pb
+        if pb is None:
+            pb = pa
+        sides = [ (ga, pa), (gb, pb) ]
+
+        out = {}
+        out['a'] = { 'pid': pa, 'generation': ga }
+        out['b'] = { 'pid': pb, 'generation': gb }
+        out['diffs'], out['tables'] = VmDiff(*sides)
+        out['generation'] = mem_generation
+        return out
+
+VmDiffCommand()
+
+#endregion
+
+#region Frame functions
+
+# '0' and '1' digits of the bytes of a free frames map (one byte per frame, 0 or 1)
+bitmap_digits = bytes.maketrans(b'\x00\x01', b'01')
+
+def frame_bitmap(frames):
+    """pack a map of one byte per frame (0 or 1) into one bit per frame, frame 0 in the LSB of the first byte"""
+    if not frames:
+        return b''
+    bits = frames.translate(bitmap_digits)[::-1]
+    return int(bits, 2).to_bytes((len(frames) + 7) // 8, 'little')
+
+def free_frames(vdf_next, n_m1, first):
+    """
+    Walk the list of free frames starting at first, following the prossimo_libero
+    fields in vdf_next. Returns (map of one byte per frame, 1 if the frame is in
+    the list; number of frames in the list; errors found)
+    """
+    free = bytearray(n_frame)
+    count = 0
+    errors = []
+    f = first
+    # the list ends with 0, which is never a frame of M2
+    while f:
+        if not n_m1 <= f < n_frame:
+            errors.append("frame {:#x} in the list of free frames is not in M2".format(f))
+            break
+        if free[f]:
+            errors.append("the list of free frames loops at frame {:#x}".format(f))
+            break
+        free[f] = 1
+        count += 1
+        f = vdf_next[f]
+    return (free, count, errors)
+
+class FrameAll(gdb.Command):
+    """Dump the accounting of the physical frames as JSON:
+    {
+        "n_frame": <number of frames>, "m1": <frames in M1>, "m2": <frames in M2>,
+        "free": <frames in the list of free frames>, "used": <frames of M2 not in the list>,
+        "num_frame_liberi": <value of the counter>,
+        "errors": [ <inconsistencies of the list of free frames, or with the counter> ],
+        "tables": [ [ <frame number>, <nvalide> ], ... ],
+        "bitmap": <base64 of one bit per frame, 1 if free, frame 0 in the LSB of the first byte>,
+        "generation": <memory generation>
+    }
+'tables' lists the used frames of M2 with a non zero nvalide: alloca_frame()
+clears the descriptor, so only the frames holding a table have one.
+The whole vdf is read with a single memory transfer, and its prossimo_libero and
+nvalide fields are decoded with the layout of des_frame in the debug info.
+With '--file', the JSON is written to a temporary file and only a handle to
+it is printed."""
+
+    name = "FrameAll"
+    flags = ('file',)
+    values = ()
+
+    def __init__(self):
+        super(FrameAll, self).__init__(self.name, gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        options, args = parse_options(arg, self.flags, self.values)
+        if args:
+            raise gdb.GdbError("usage: FrameAll [--file]")
+        write_output(self.name, cached_output(self, options), options)
+
+    def compute(self, options):
+        n_m1 = readfis(n_m1_addr)
+        first = readfis(primo_frame_libero_addr)
+        num_liberi = readfis(num_frame_liberi_addr)
+        try:
+            next_column = des_frame_layout.column(n_frame, 'prossimo_libero')
+            nvalide_column = des_frame_layout.column(n_frame, 'nvalide')
+        except KeyError:
+            raise gdb.GdbError("des_frame has no scalar prossimo_libero and nvalide fields")
+        # a single transfer, bypassing the page cache: the output is cached anyway
+        raw = bytes(qemu.read_memory(vdf_addr, n_frame * des_frame_layout.size))
+        vdf_next = next_column.unpack_from(raw)
+        nvalide = nvalide_column.unpack_from(raw)
+
+        free, count, errors = free_frames(vdf_next, n_m1, first)
+        if not errors and count != num_liberi:
+            errors.append("num_frame_liberi is {} but the list of free frames has {} frames".format(num_liberi, count))
+
+        out = {}
+        out['n_frame'] = n_frame
+        out['m1'] = n_m1
+        out['m2'] = n_frame - n_m1
+        out['free'] = count
+        out['used'] = n_frame - n_m1 - count
+        out['num_frame_liberi'] = num_liberi
+        out['errors'] = errors
+        out['tables'] = [ [ f, nvalide[f] ] for f in compress(range(n_m1, n_frame), nvalide[n_m1:]) if not free[f] ]
+        out['bitmap'] = base64.b64encode(frame_bitmap(free)).decode('ascii')
+        out['generation'] = mem_generation
+        return out
+
+FrameAll()
+
+#endregion
+
+class NucleoAll(gdb.Command):
+    """Dump the outputs of ProcessAll ('process') and MemoryAll ('memory') together as JSON:
+    {"generation": <memory generation>, "process": {...}, "memory": {...}}
+Both sections are included unless some are named. The options of both commands are
+accepted and passed to the section they belong to. With '--since <generation>', the
+sections are left out if the memory generation is still the given one.
+With '--file', the JSON is written to a temporary file and only a handle to it is printed."""
+
+    name = "NucleoAll"
+    sections = { 'process': process_all, 'memory': memory_all }
+
+    def __init__(self):
+        super(NucleoAll, self).__init__(self.name, gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        flags = process_all.flags + memory_all.flags
+        values = process_all.values + memory_all.values + ('since',)
+        options, args = parse_options(arg, flags, values)
+        usage = "usage: NucleoAll [process] [memory] [--since <generation>] [<options of ProcessAll and MemoryAll>]"
+        if any(a not in self.sections for a in args):
+            raise gdb.GdbError(usage)
+        try:
+            since = int(options['since']) if 'since' in options else None
+        except ValueError:
+            raise gdb.GdbError(usage)
+
+        # the sections are already JSON, they are only joined
+        parts = [ '"generation": {}'.format(mem_generation) ]
+        if since != mem_generation:
+            for name in args or sorted(self.sections):
+                cmd = self.sections[name]
+                cmd_options = { k: v for k, v in options.items() if k in cmd.flags + cmd.values }
+                parts.append('"{}": {}'.format(name, cached_output(cmd, cmd_options)))
+        write_output(self.name, "{" + ", ".join(parts) + "}", options)
+
+NucleoAll()
+
+#region Timeline
+
+# The state of the scheduler at the last stops, in a ring buffer of timeline_size
+# records, empty unless asked for: recording reads the scheduler structures at
+# every stop, even with no panel open. Each record is a tuple of numbers and tuples of numbers (see timeline_record);
+# stop number n is in timeline[n % len(timeline)], with timeline_count stops recorded.
+timeline = []
+timeline_count = 0
+
+class NucleoTimelineSize(gdb.Parameter):
+    """Number of stops remembered by Timeline (0 to stop recording).
+Changing it forgets the stops recorded so far."""
+
+    set_doc = "Set the number of stops remembered by Timeline."
+    show_doc = "Show the number of stops remembered by Timeline."
+
+    def __init__(self):
+        super(NucleoTimelineSize, self).__init__("nucleo-timeline-size", gdb.COMMAND_DATA, gdb.PARAM_ZUINTEGER)
+        self.value = 0
+        self.get_set_string()
+
+    def get_set_string(self):
+        global timeline, timeline_count
+        timeline = [None] * self.value
+        timeline_count = 0
+        return ""
+
+    def get_show_string(self, svalue):
+        return "Timeline remembers {} stops.".format(svalue)
+
+timeline_size = NucleoTimelineSize()
+
+def timeline_record():
+    """
+    The state of the scheduler, read from raw memory:
+        (memory generation, pid of esecuzione (or None), processi,
+         pids in pronti, pids in sospesi,
+         counters of the allocated semaphores (utente, then sistema),
+         (index, pids in the queue) of the semaphores with a waiting queue)
+    """
+    esec = readfis(esecuzione_addr)
+
+    # only the counters and the queue heads of the semaphores, a column at a time
+    counters = ()
+    queues = []
+    for base, n in sem_ranges():
+        addr = array_dess_addr + base * des_sem_layout.size
+        counters += des_sem_layout.read_column(addr, n, 'counter')
+        pointers = des_sem_layout.read_column(addr, n, 'pointer')
+        queues += [ (base + i, tuple(show_list_raw(pointers[i], 'id', 'puntatore', int))) for i in compress(range(n), pointers) ]
+
+    return (mem_generation,
+            des_proc_layout.read_field(esec, 'id') if esec else None,
+            readnatl(processi_addr),
+            tuple(show_list_raw(readfis(pronti_addr), 'id', 'puntatore', int)),
+            tuple(des_proc_layout.read_field(r['pp'], 'id') for r in sospesi_list()),
+            counters,
+            tuple(queues))
+
+def timeline_stop(event):
+    """record the state of the scheduler at every stop"""
+    global timeline_count
+
+    if not timeline:
+        return
+    try:
+        record = timeline_record()
+    except (gdb.MemoryError, gdb.error):
+        # e.g. before the nucleo has initialized its structures
+        return
+    timeline[timeline_count % len(timeline)] = record
+    timeline_count += 1
+
+# after the page cache has been invalidated by the same event
+gdb.events.stop.connect(timeline_stop)
+
+class Timeline(gdb.Command):
+    """Dump the state of the scheduler at the last stops as JSON.
+Usage: Timeline [<from>] [<to>]
+<from> and <to> are stop numbers (negative ones count from the last stop, -1
+being the last one); by default, all the stops still remembered are shown.
+The stops are remembered only with 'set nucleo-timeline-size <n>'.
+The output is structured as:
+    {
+        "first": <first stop remembered>, "last": <last stop>,
+        "stops": [
+            {
+                "stop": <stop number>, "generation": <memory generation>,
+                "esecuzione": <pid or null>, "processi": <number of user processes>,
+                "pronti": [ <pid>, ... ], "sospesi": [ <pid>, ... ],
+                "sem_counters": [ <counter of each allocated semaphore, utente then sistema> ],
+                "sem_queues": [ [ <semaphore index>, [ <pid>, ... ] ], ... ]
+            },
+            ...
+        ]
+    }"""
+
+    name = "Timeline"
+
+    def __init__(self):
+        super(Timeline, self).__init__(self.name, gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) > 2:
+            raise gdb.GdbError("usage: Timeline [<from>] [<to>]")
+        try:
+            bounds = [ int(a, 0) for a in argv ]
+        except ValueError:
+            raise gdb.GdbError("usage: Timeline [<from>] [<to>]")
+
+        # the stops still in the ring buffer
+        first = max(0, timeline_count - len(timeline))
+        last = timeline_count - 1
+        start, end = first, last
+        if len(bounds) > 0:
+            start = bounds[0] if bounds[0] >= 0 else timeline_count + bounds[0]
+        if len(bounds) > 1:
+            end = bounds[1] if bounds[1] >= 0 else timeline_count + bounds[1]
+
+        keys = ('generation', 'esecuzione', 'processi', 'pronti', 'sospesi', 'sem_counters', 'sem_queues')
+        stops = []
+        for n in range(max(start, first), min(end, last) + 1):
+            stop = dict(zip(keys, timeline[n % len(timeline)]))
+            stop['stop'] = n
+            stops.append(stop)
+        gdb.write(json.dumps({ 'first': first, 'last': last, 'stops': stops }) + "\n")
+
+Timeline()
+
+#endregion
+
+#region Snapshot
+
+def snapshot_tables(roots):
+    """the frames of the tables reachable from the root tables in roots"""
+    frames = set()
+    visited = set()
+    todo = [ (cr3 & paddr_mask, max_liv) for cr3 in roots ]
+    while todo:
+        tab, liv = todo.pop()
+        if (tab, liv) in visited:
+            continue
+        visited.add((tab, liv))
+        frames.add(tab // page_size)
+        if liv == 1:
+            continue
+        entries = readtab(tab)
+        todo += [ (entries[i] & paddr_mask, liv - 1) for i in range(tab_entries) if vm_is_table[entries[i] & 0xfff] ]
+    return frames
+
+def snapshot_frames(symbols):
+    """
+    The frames needed to decode the nucleo data structures: those of the global
+    variables in symbols (name -> address, as recorded by record.py), of the live
+    des_proc, of the richiesta in sospesi, of the interrupt frame saved on the
+    stack of every process and of every table reachable from a cr3
+    """
+    frames = set()
+    def add(addr, size):
+        frames.update(range(addr // page_size, (addr + size - 1) // page_size + 1))
+
+    for name, addr in symbols.items():
+        add(addr, gdb.parse_and_eval(name).type.sizeof)
+    # the whole array_dess, not only the allocated semaphores
+    add(array_dess_addr, (max_sem * 2) * des_sem_layout.size)
+    for request in sospesi_requests():
+        add(request, richiesta_layout.size)
+
+    roots = { toi(gdb.parse_and_eval('$cr3')) }
+    for pid, addr in process_table():
+        add(addr, des_proc_layout.size)
+        proc = des_proc_layout.read(addr)
+        roots.add(proc['cr3'])
+        stack = v2p(proc['cr3'], proc['contesto'][4])
+        if stack is not None:
+            add(stack, int_frame_struct.size)
+    return frames | snapshot_tables(roots)
+
+class NucleoSave(gdb.Command):
+    """Save the state of the nucleo into a snapshot file.
+Usage: NucleoSave <file>
+The snapshot contains the pages of proc_table, of the live des_proc, of array_dess,
+of the richiesta in sospesi, of vdf and of all the tables reachable from the cr3
+of every process, together with the types, symbols and registers needed to decode
+them. It is written in the format of nucleo_snapshot.py (a header, the index of
+the pages and the pages at page boundaries, so that it can be mapped in memory):
+MemoryImage.load of debug/bench/image.py reads it back, and ProcessAll and
+MemoryAll can then run on it through the stand-in gdb module of debug/bench."""
+
+    name = "NucleoSave"
+
+    def __init__(self):
+        super(NucleoSave, self).__init__(self.name, gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) != 1:
+            raise gdb.GdbError("usage: NucleoSave <file>")
+
+        meta = nucleo_snapshot.record_meta()
+        symbols = { name: s[0] for name, s in meta['symbols'].items() }
+        pages = { f: readpage(f) for f in sorted(snapshot_frames(symbols)) }
+        meta['functions'] = nucleo_snapshot.record_functions(pages, meta)
+        nucleo_snapshot.write_snapshot(argv[0], meta, pages)
+        gdb.write("{}: {} pages, {} functions\n".format(argv[0], len(pages), len(meta['functions'])))
+
+NucleoSave()
+
+#endregion
+
+#region Precomputation
+
+class NucleoPrecompute(gdb.Parameter):
+    """Whether the outputs of ProcessAll and MemoryAll requested since the previous stop
+are computed again as soon as the target stops, before they are requested."""
+
+    set_doc = "Set whether the nucleo outputs are computed at every stop."
+    show_doc = "Show whether the nucleo outputs are computed at every stop."
+
+    def __init__(self):
+        super(NucleoPrecompute, self).__init__("nucleo-precompute", gdb.COMMAND_DATA, gdb.PARAM_BOOLEAN)
+        self.value = True
+
+    def get_set_string(self):
+        return ""
+
+    def get_show_string(self, svalue):
+        return "Precomputation of the nucleo outputs at every stop is {}.".format(svalue)
+
+precompute = NucleoPrecompute()
+
+def precompute_outputs(event):
+    """
+    Compute the outputs requested since the previous stop, so that they are
+    ready when the clients ask for them again. Only the outputs that somebody
+    asked for are computed, and only once per stop.
+    """
+    global output_requests
+
+    requests = output_requests
+    output_requests = {}
+    if not precompute.value:
+        return
+
+    for cmd, options in requests.values():
+        next_options = getattr(cmd, 'next_options', None)
+        try:
+            if next_options is not None:
+                options = next_options(options)
+            cached_output(cmd, options, remember=False)
+        except Exception:
+            # computed again (reporting the error) when requested
+            pass
+
+# after the page cache has been invalidated by the same event
+gdb.events.stop.connect(precompute_outputs)
+
+#endregion